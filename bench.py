@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# license: WTFPLv2 [http://wtfpl.net]
+
+"""Benchmarks of chronocalc hot paths
+
+Each benchmark is run several times and the best time per expression is
+reported, in microseconds, as JSON. Results can be saved and later compared
+to a baseline:
+
+	python3 bench.py --save baseline.json
+	python3 bench.py --baseline baseline.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+
+import chronocalc
+
+
+UNITS = ['years', 'months', 'weeks', 'days', 'hours', 'minutes', 'seconds', 'ms', 'us']
+
+
+def duration_list(n):
+	return ', '.join('%d %s' % (i + 1, unit) for i, unit in enumerate(UNITS[:n]))
+
+
+CORPORA = {
+	# long lists of durations, added and subtracted
+	'durations': [
+		duration_list(len(UNITS)),
+		' + '.join(duration_list(n) for n in range(1, len(UNITS) + 1)),
+		' - '.join('%d hours, %d minutes' % (i, i * 7 % 60) for i in range(1, 40)),
+	],
+	# deeply nested parentheses
+	'nested': [
+		'(' * 30 + '1 day' + ' * 2)' * 30,
+		'(' * 30 + '1 hour' + ' + 1 minute)' * 30,
+		'((((((((2015-07-31 + 1 day) - 1 hour) + 3 months) - 2 weeks) + 1 year) - 5 minutes) + 1 s) - 1 ms)',
+	],
+	# every Datetime literal form
+	'datetimes': [
+		'now - epoch',
+		'today + 1 day',
+		'2015-07-31T12:34:56 - 2015-07-31',
+		'2015-212 - 2015W311',
+		'20150731T1234 - 2015-W31-1',
+		'2015/07/31 3pm - 15/7/31',
+		'2015-7-31 13:20:10.123 - 2015/07/31 1.20.10.123456 am',
+		'2015/07/31 12:00 - 00:00',
+		'15:20 + 1 hour',
+	],
+	# mixed arithmetic on numbers
+	'numbers': [
+		'1 day / 2',
+		'3 * 2 days / 1.5 + 4 hours * -0.25',
+		'(2015/08/15 - 2015/07/15) / 1 day',
+	],
+}
+
+
+def bench(func, args, repeat, number):
+	"""Return the best time of func(*args) in microseconds"""
+	timer = timeit.Timer(lambda: func(*args))
+	return min(timer.repeat(repeat=repeat, number=number)) / number * 1e6
+
+
+def run_compute(ast):
+	return chronocalc.do_compute(ast)
+
+
+def run_end_to_end(text):
+	chronocalc.CACHE.clear()
+	return chronocalc.compute_from_string(text)
+
+
+def run_cached(text):
+	return chronocalc.compute_from_string(text)
+
+
+def bench_corpus(name, texts, repeat, number):
+	results = {}
+	entry = chronocalc.GRAMMAR_ENTRY
+	tokens = [chronocalc.do_lexer(text) for text in texts]
+	asts = [chronocalc.do_parser(entry, toks) for toks in tokens]
+
+	for key, func, inputs in (
+		('lexer', chronocalc.do_lexer, texts),
+		('parser', lambda toks: chronocalc.do_parser(entry, toks), tokens),
+		('compute', run_compute, asts),
+		('end_to_end', run_end_to_end, texts),
+		('cached', run_cached, texts),
+	):
+		total = sum(bench(func, (value,), repeat, number) for value in inputs)
+		results['%s.%s' % (key, name)] = total / len(inputs)
+	return results
+
+
+STARTUP_CODE = 'import sys; from chronocalc import main; sys.argv[0] = "chronocalc"; sys.exit(main())'
+
+
+def subprocess_env():
+	"""Return the environment for running the benchmarked chronocalc in a subprocess"""
+	env = dict(os.environ)
+	env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(chronocalc.__file__)), env.get('PYTHONPATH')]))
+	return env
+
+
+def bench_startup(repeat):
+	"""Return the best wall time in microseconds of running the CLI once"""
+	cmd = [sys.executable, '-c', STARTUP_CODE, '1 day / 2']
+	env = subprocess_env()
+
+	best = float('inf')
+	for _ in range(repeat):
+		start = time.perf_counter()
+		subprocess.run(cmd, env=env, check=True, stdout=subprocess.DEVNULL)
+		best = min(best, time.perf_counter() - start)
+	return best * 1e6
+
+
+def import_times(repeat, code='import chronocalc'):
+	"""Return the best cumulative import times in microseconds, from python -X importtime
+
+	Only chronocalc and the modules it imports directly are returned, keyed
+	by module name.
+	"""
+	cmd = [sys.executable, '-X', 'importtime', '-c', code]
+	env = subprocess_env()
+
+	best = {}
+	for _ in range(repeat):
+		proc = subprocess.run(cmd, env=env, check=True, stderr=subprocess.PIPE, universal_newlines=True)
+		children = {}
+		for line in proc.stderr.splitlines():
+			if not line.startswith('import time:'):
+				continue
+			_, cumulative, name = line.split('|')
+			if not cumulative.strip().isdigit():
+				continue
+
+			# a module is listed after the modules it imports, indented by 2 more spaces
+			level = (len(name) - len(name.lstrip())) // 2
+			name = name.strip()
+			if level == 1:
+				children[name] = int(cumulative)
+			elif level == 0:
+				if name == 'chronocalc':
+					children[name] = int(cumulative)
+					for key, value in children.items():
+						best[key] = min(best.get(key, float('inf')), value)
+				children = {}
+	return best
+
+
+def run(repeat=5, number=200, startup_repeat=10, only=None):
+	results = {}
+	for name, texts in CORPORA.items():
+		if only and name not in only:
+			continue
+		results.update(bench_corpus(name, texts, repeat, number))
+	if not only or 'startup' in only:
+		results['startup'] = bench_startup(startup_repeat)
+		results['import'] = import_times(startup_repeat)['chronocalc']
+	return results
+
+
+def compare(results, baseline, threshold):
+	"""Print a comparison table, return the names of regressed benchmarks"""
+	regressions = []
+	for name in sorted(results):
+		new = results[name]
+		old = baseline.get(name)
+		if old is None:
+			print('%-24s %12.2f us' % (name, new))
+			continue
+
+		ratio = new / old
+		flag = ''
+		if ratio > 1 + threshold:
+			flag = '  REGRESSION'
+			regressions.append(name)
+		print('%-24s %12.2f us %12.2f us %7.2fx%s' % (name, new, old, ratio, flag))
+	return regressions
+
+
+def main():
+	aparser = argparse.ArgumentParser(description='Benchmark chronocalc')
+	aparser.add_argument('--repeat', type=int, default=5, help='take the best of N runs (default: %(default)s)')
+	aparser.add_argument('--number', type=int, default=200, help='evaluate N times per run (default: %(default)s)')
+	aparser.add_argument('--only', action='append', choices=sorted(CORPORA) + ['startup'], help='only run these benchmarks')
+	aparser.add_argument('--save', metavar='FILE', help='save the results to FILE')
+	aparser.add_argument('--baseline', metavar='FILE', help='compare the results to those saved in FILE')
+	aparser.add_argument(
+		'--import-time', action='store_true',
+		help='only print how long importing chronocalc and each module it imports takes',
+	)
+	aparser.add_argument(
+		'--threshold', type=float, default=0.1,
+		help='with --baseline, slowdown ratio reported as regression (default: %(default)s)',
+	)
+	args = aparser.parse_args()
+
+	if args.import_time:
+		json.dump(import_times(args.repeat), sys.stdout, indent=2, sort_keys=True)
+		print()
+		return
+
+	results = run(repeat=args.repeat, number=args.number, only=args.only)
+	data = {
+		'version': chronocalc.__version__,
+		'python': platform.python_version(),
+		'unit': 'us',
+		'results': results,
+	}
+
+	if args.save:
+		with open(args.save, 'w') as fd:
+			json.dump(data, fd, indent=2, sort_keys=True)
+
+	if args.baseline:
+		with open(args.baseline) as fd:
+			baseline = json.load(fd)['results']
+		if compare(results, baseline, args.threshold):
+			sys.exit(1)
+	elif not args.save:
+		json.dump(data, sys.stdout, indent=2, sort_keys=True)
+		print()
+
+
+if __name__ == '__main__':
+	main()
@@ -2,50 +2,255 @@
 # coding: utf-8
 # license: this file is licensed under the WTFPLv2 license (see COPYING.wtfpl)
 
-import argparse
 import datetime
+import functools
+import itertools
+import math
+import os
 import re
 import sys
-from collections import OrderedDict
+import time
+from collections import OrderedDict, deque, namedtuple
 
 try:
-	from dateutil.relativedelta import relativedelta
+	from re import _constants as sre_constants, _parser as sre_parse
 except ImportError:
-	print('Please install python-relativedelta', file=sys.stderr)
-	sys.exit(1)
+	import sre_constants
+	import sre_parse
+
+
+def relativedelta(*args, **kwargs):
+	"""Create a dateutil relativedelta
+
+	dateutil is only imported when first needed, because it is slow to import
+	and durations without months or years do not need it. This function is
+	then replaced by the relativedelta class.
+	"""
+	global relativedelta
+
+	try:
+		from dateutil.relativedelta import relativedelta
+	except ImportError:
+		print('Please install python-relativedelta', file=sys.stderr)
+		sys.exit(1)
+	return relativedelta(*args, **kwargs)
+
+
+def is_relativedelta(obj):
+	module = sys.modules.get('dateutil.relativedelta')
+	return module is not None and isinstance(obj, module.relativedelta)
 
 
 __version__ = "0.9.1"
 
 
+# {{{ instrumentation
+
+class Stats(object):
+	"""Counters and timings of evaluations, collected while enabled
+
+	Counters are the tokens lexed, the parser rules tried and those which
+	failed (making the parser backtrack to the next alternative), the packrat
+	memo hits, and the expression cache hits and misses. For each stage (lex,
+	parse, optimize, compute), the number of runs and the total time in
+	seconds are kept.
+	"""
+
+	COUNTERS = ('tokens', 'rule_attempts', 'backtracks', 'memo_hits', 'cache_hits', 'cache_misses')
+	STAGES = ('lex', 'parse', 'optimize', 'compute')
+
+	def __init__(self):
+		self.reset()
+
+	def reset(self):
+		for name in self.COUNTERS:
+			setattr(self, name, 0)
+		self.runs = dict.fromkeys(self.STAGES, 0)
+		self.times = dict.fromkeys(self.STAGES, 0.)
+
+	def add_time(self, stage, start):
+		"""Count a run of stage, started at time.perf_counter() value start"""
+		self.runs[stage] += 1
+		self.times[stage] += time.perf_counter() - start
+
+	def as_dict(self):
+		d = {name: getattr(self, name) for name in self.COUNTERS}
+		d['runs'] = dict(self.runs)
+		d['times'] = dict(self.times)
+		return d
+
+	def merge(self, d):
+		"""Add the stats of another process, given as returned by as_dict()"""
+		for name in self.COUNTERS:
+			setattr(self, name, getattr(self, name) + d[name])
+		for stage in self.STAGES:
+			self.runs[stage] += d['runs'][stage]
+			self.times[stage] += d['times'][stage]
+
+	def __str__(self):
+		lines = ['%s: %d' % (name.replace('_', ' '), getattr(self, name)) for name in self.COUNTERS]
+		for stage in self.STAGES:
+			lines.append('%s: %d runs, %.6f s' % (stage, self.runs[stage], self.times[stage]))
+		return '\n'.join(lines)
+
+
+# instrumentation is off when None, so it costs a global lookup per check
+STATS = None
+
+
+def enable_stats():
+	"""Start collecting Stats, and return them"""
+	global STATS
+
+	if STATS is None:
+		STATS = Stats()
+	return STATS
+
+
+def disable_stats():
+	"""Stop collecting Stats, and return the collected ones"""
+	global STATS
+
+	stats, STATS = STATS, None
+	return stats
+
+# }}}
+
 # {{{ parser lib
 
 TERMINAL_CLASSES = []
 NONTERMINAL_CLASSES = []
 
 def register(cls):
+	global LEXER
+
 	if cls.is_terminal:
 		TERMINAL_CLASSES.append(cls)
+		LEXER = None
 	else:
 		NONTERMINAL_CLASSES.append(cls)
+		# Lazy symbols may now resolve differently
+		RULE_TABLES.clear()
 	return cls
 
 # {{{ lexer
 
+class LazyRegex(object):
+	"""Class attribute holding a regex, compiled on first access
+
+	Once compiled, the regex replaces the descriptor in the class.
+	"""
+
+	def __init__(self, pattern, flags=0):
+		self.pattern = pattern
+		self.flags = flags
+		self.name = None
+
+	def __set_name__(self, owner, name):
+		self.name = name
+
+	def __get__(self, obj, owner):
+		compiled = re.compile(self.pattern, self.flags)
+		for cls in owner.__mro__:
+			if cls.__dict__.get(self.name) is self:
+				setattr(cls, self.name, compiled)
+		return compiled
+
+	@staticmethod
+	def source(owner, name='re'):
+		"""Return the (pattern, flags) of a regex attribute without compiling it"""
+		for cls in owner.__mro__:
+			if name in cls.__dict__:
+				value = cls.__dict__[name]
+				return value.pattern, value.flags
+		raise AttributeError(name)
+
+
 class Terminal(object):
+	"""Token, the substring text[start:end] matched by the class regex
+
+	The named groups of the match are only decoded when d is first used.
+	"""
+
+	__slots__ = ('text', 'start', 'end', '_d')
+
 	is_terminal = True
 	is_lazy = False
+	is_many = False
 	re = None
 	ignore = False
 
-	def __init__(self, d=None, match=None):
-		self.d = d
-		self.match = match
+	def __init__(self, text=None, start=0, end=0):
+		self.text = text
+		self.start = start
+		self.end = end
+		self._d = None
+
+	@property
+	def match(self):
+		if self.text is None:
+			return None
+		return self.re.match(self.text, self.start, self.end)
+
+	@property
+	def d(self):
+		"""Dict of the named groups which matched, aliases being merged"""
+		if self._d is None and self.text is not None:
+			groups = self.match.groups()
+			d = {}
+			for name, numbers in self.group_index().items():
+				for number in numbers:
+					if groups[number - 1] is not None:
+						d[name] = groups[number - 1]
+			self._d = d
+		return self._d
+
+	@classmethod
+	def group_index(cls):
+		"""Return a dict mapping the group names of the regex to group numbers
+
+		Groups named like "ampm_2" are aliases of "ampm", as a regex can't
+		have twice the same group name: their numbers are listed after the
+		number of the group they alias. Computed once per class.
+		"""
+		index = cls.__dict__.get('_group_index')
+		if index is None:
+			index = {}
+			for name, number in sorted(cls.re.groupindex.items(), key=lambda item: item[1]):
+				index.setdefault(re.sub(r'_\d$', '', name), []).append(number)
+			cls._group_index = index
+		return index
+
+	def group(self):
+		"""Return the text of the token"""
+		return self.text[self.start:self.end]
+
+	def groups(self, *names):
+		"""Return the values of named groups, None for those which didn't match
+
+		Faster than d when only a few groups are used.
+		"""
+		if self._d is not None:
+			return tuple(self._d.get(name) for name in names)
+
+		groups = self.match.groups()
+		index = self.group_index()
+		values = []
+		for name in names:
+			value = None
+			for number in index[name]:
+				if groups[number - 1] is not None:
+					value = groups[number - 1]
+			values.append(value)
+		return tuple(values)
 
 	@classmethod
 	def name(cls):
 		return cls.__name__
 
+	def is_time_dependent(self):
+		return False
+
 	def __repr__(self):
 		return '<%s %r>' % (self.name(), self.d)
 
@@ -55,7 +260,8 @@ class Terminal(object):
 
 def create_terminal(re_string):
 	class NewTerminal(Terminal):
-		re = re.compile(re_string)
+		__slots__ = ()
+		re = LazyRegex(re_string)
 
 	return NewTerminal
 
@@ -63,20 +269,6 @@ def create_terminal(re_string):
 literal_re = re.escape
 
 
-def tweak_match_dict(d):
-	for k in list(d.keys()):
-		if d[k] is None:
-			del d[k]
-
-	for k in list(d.keys()):
-		mtc = re.match(r'(.*)_\d$', k)
-		if mtc:
-			newkey = mtc.expand(r'\1')
-			d[newkey] = d[k]
-			del d[k]
-	return d
-
-
 class ParserException(Exception):
 	reason = None
 
@@ -111,12 +303,12 @@ class ParserException(Exception):
 		return '\n'.join([line1, line2])
 
 	def location_str(self):
-		if self.text:
+		if self.text is not None:
 			return self.snippet_str(self.text, self.pos)
 		elif self.token:
-			return self.snippet_str(self.token.match.string, self.token.match.start())
+			return self.snippet_str(self.token.text, self.token.start)
 		elif self.after_token:
-			return self.snippet_str(self.after_token.match.string, self.after_token.match.end())
+			return self.snippet_str(self.after_token.text, self.after_token.end)
 
 	def __str__(self):
 		if self.exc:
@@ -130,30 +322,142 @@ class BadToken(ParserException):
 	reason = 'Unrecognized token'
 
 
+class Lexer(object):
+	"""Lexer dispatching on the first character of tokens
+
+	For each character, the terminal classes whose regex may match a string
+	starting with it are found once, by walking the parsed regexes. Lexing a
+	position then only tries these few candidates instead of every terminal.
+	The longest match wins, and on ties the first class wins.
+	"""
+
+	CATEGORIES = {
+		sre_constants.CATEGORY_DIGIT: r'\d',
+		sre_constants.CATEGORY_NOT_DIGIT: r'\D',
+		sre_constants.CATEGORY_SPACE: r'\s',
+		sre_constants.CATEGORY_NOT_SPACE: r'\S',
+		sre_constants.CATEGORY_WORD: r'\w',
+		sre_constants.CATEGORY_NOT_WORD: r'\W',
+	}
+
+	REPEATS = (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT)
+	ZERO_WIDTH = (sre_constants.AT, sre_constants.ASSERT, sre_constants.ASSERT_NOT)
+
+	def __init__(self, classes):
+		self.classes = tuple(classes)
+		self.trees = None
+		self.dispatch = {}
+
+	def parse_trees(self):
+		self.trees = []
+		for cls in self.classes:
+			pattern, flags = LazyRegex.source(cls)
+			if flags & re.I:
+				self.trees.append(None)
+			else:
+				self.trees.append(sre_parse.parse(pattern, flags))
+
+	@classmethod
+	def in_set(cls, items, char):
+		found = negate = False
+		for op, av in items:
+			if op is sre_constants.NEGATE:
+				negate = True
+			elif op is sre_constants.LITERAL:
+				found = found or av == ord(char)
+			elif op is sre_constants.RANGE:
+				found = found or av[0] <= ord(char) <= av[1]
+			elif op is sre_constants.CATEGORY and av in cls.CATEGORIES:
+				found = found or bool(re.match(cls.CATEGORIES[av], char))
+			else:
+				return True
+		return found != negate
+
+	@classmethod
+	def may_start(cls, items, char):
+		"""Tell if parsed regex items may match a string starting with char
+
+		Return a (may_start, may_be_empty) pair. Constructs not handled here are
+		assumed to start with anything.
+		"""
+		for op, av in items:
+			if op is sre_constants.LITERAL:
+				start, empty = av == ord(char), False
+			elif op is sre_constants.NOT_LITERAL:
+				start, empty = av != ord(char), False
+			elif op is sre_constants.IN:
+				start, empty = cls.in_set(av, char), False
+			elif op in cls.ZERO_WIDTH:
+				start, empty = False, True
+			elif op is sre_constants.SUBPATTERN and not av[1] & re.I:
+				start, empty = cls.may_start(av[-1], char)
+			elif op in cls.REPEATS:
+				start, empty = cls.may_start(av[2], char)
+				empty = empty or av[0] == 0
+			elif op is sre_constants.BRANCH:
+				results = [cls.may_start(branch, char) for branch in av[1]]
+				start = any(res[0] for res in results)
+				empty = any(res[1] for res in results)
+			else:
+				return True, True
+
+			if start:
+				return True, True
+			elif not empty:
+				return False, False
+		return False, True
+
+	def candidates(self, char):
+		if self.trees is None:
+			self.parse_trees()
+		return tuple(
+			cls for cls, tree in zip(self.classes, self.trees)
+			if tree is None or self.may_start(tree, char)[0]
+		)
+
+	def match(self, text, start):
+		"""Return the terminal class and regex match of the longest token at start
+
+		Return (None, None) if no terminal matches.
+		"""
+		char = text[start]
+		try:
+			candidates = self.dispatch[char]
+		except KeyError:
+			candidates = self.dispatch[char] = self.candidates(char)
+
+		best_cls = best_match = None
+		best = start
+		for cls in candidates:
+			mtc = cls.re.match(text, start)
+			if mtc is not None and mtc.end() > best:
+				best_cls = cls
+				best_match = mtc
+				best = mtc.end()
+		return best_cls, best_match
+
+
+LEXER = None
+
+def get_lexer():
+	global LEXER
+
+	if LEXER is None:
+		LEXER = Lexer(TERMINAL_CLASSES)
+	return LEXER
+
+
 def do_lexer(text):
 	tokens = []
 	start = 0
+	match = get_lexer().match
 
 	while start < len(text):
-		best = None
-		best_cls = None
-		best_match = None
-		for cls in TERMINAL_CLASSES:
-			mtc = cls.re.match(text, start)
-			if mtc:
-				new = mtc.end()
-			if mtc and (not best or best < new):
-				best_match = mtc
-				best_cls = cls
-				best = new
+		best_cls, best_match = match(text, start)
 
 		if best_match:
-			assert best_match.start() != best_match.end()
-
 			if not best_cls.ignore:
-				d = tweak_match_dict(best_match.groupdict())
-				token = best_cls(d, match=best_match)
-				tokens.append(token)
+				tokens.append(best_cls(text, start, best_match.end()))
 			start = best_match.end()
 		else:
 			raise BadToken(pos=start, text=text)
@@ -168,6 +472,7 @@ class NonTerminal(object):
 	rules = None
 	is_dummy = False
 	is_lazy = False
+	is_many = False
 
 	def __init__(self, parts):
 		self.parts = parts
@@ -196,6 +501,29 @@ class Lazy(NonTerminal):
 		assert False, '%s not found' % self.name
 
 
+class Many(NonTerminal):
+	"""Symbol repeated zero or more times, parsed as a list
+
+	Repetitions are parsed in a loop, so long sequences don't recurse like
+	right-recursive rules do.
+	"""
+	is_many = True
+
+	def __init__(self, sym):
+		self.sym = sym
+
+	def resolve(self):
+		if self.sym.is_lazy:
+			return Many(self.sym.lookup())
+		return self
+
+	def __eq__(self, other):
+		return isinstance(other, Many) and other.sym == self.sym
+
+	def __hash__(self):
+		return hash((Many, self.sym))
+
+
 def rule(*syms):
 	def deco(func):
 		func.syms = syms
@@ -209,7 +537,7 @@ class BadRule(ParserException):
 
 
 class BadSymbol(ParserException):
-	pass
+	reason = 'Unexpected symbol'
 
 
 class ExtraTokensError(ParserException):
@@ -224,56 +552,140 @@ class ParserSyntaxError(ParserException):
 	reason = 'Unexpected symbol'
 
 
-def parse_rule(syms, tokens, start):
+def parse_rule(syms, tokens, start, memo=None):
+	"""Parse the symbols of a rule from tokens[start:]
+
+	Return (end, parts), or None if the rule does not match at start. Failures
+	are not signalled with exceptions, as alternatives fail all the time.
+	But once a symbol was parsed, the rule is committed to, and failing
+	later raises a ParserException.
+	"""
+	if STATS is not None:
+		STATS.rule_attempts += 1
+
 	parts = []
-	consumed = False
-	try:
-		for sym in syms:
-			if sym.is_terminal:
-				if start >= len(tokens):
-					raise BadRule()
-				elif isinstance(tokens[start], sym):
-					part = tokens[start]
-					start = start + 1
-				else:
-					raise BadRule()
-			else:
-				start, part = parse_nonterm(sym, tokens, start)
-			parts.append(part)
-			consumed = True
-		return start, parts
-	except (BadRule, BadSymbol):
-		if consumed:
+	for sym in syms:
+		if sym.is_terminal:
+			if start < len(tokens) and isinstance(tokens[start], sym):
+				parts.append(tokens[start])
+				start += 1
+				continue
+		elif sym.is_many:
+			items = []
+			while True:
+				res = parse_nonterm(sym.sym, tokens, start, memo)
+				if res is None:
+					break
+				start, item = res
+				items.append(item)
+			parts.append(items)
+			continue
+		else:
+			res = parse_nonterm(sym, tokens, start, memo)
+			if res is not None:
+				start, part = res
+				parts.append(part)
+				continue
+
+		if parts:
 			if start >= len(tokens):
 				raise NotEnoughTokens(after_token=tokens[-1])
 			raise ParserSyntaxError(token=tokens[start])
-		raise
 
+		if STATS is not None:
+			STATS.backtracks += 1
+		return None
+	return start, parts
 
-def parse_nonterm(nonterm, tokens, start):
-	def lazy_replace(t):
-		if t.is_lazy:
-			return t.lookup()
-		return t
 
+RULE_TABLES = {}
+
+def resolve_symbol(sym):
+	if sym.is_lazy:
+		return sym.lookup()
+	elif sym.is_many:
+		return sym.resolve()
+	return sym
+
+
+def compile_rules(nonterm):
+	"""Return the (syms, callback) rules of nonterm, in the order they are tried
+
+	Lazy symbols are resolved to their nonterminal class.
+	"""
+	rules = []
 	for rulename in sorted(dir(nonterm)):
 		cb = getattr(nonterm, rulename)
 		if not (callable(cb) and hasattr(cb, 'syms')):
 			continue
-		try:
-			syms = map(lazy_replace, cb.syms)
-			start, parts = parse_rule(syms, tokens, start)
-		except (BadRule, BadSymbol):
-			pass
-		else:
+		syms = tuple(resolve_symbol(sym) for sym in cb.syms)
+		rules.append((syms, cb))
+	return tuple(rules)
+
+
+def compile_grammar(entry):
+	"""Fill RULE_TABLES for every nonterminal reachable from entry"""
+	pending = [entry]
+	while pending:
+		nonterm = pending.pop()
+		if nonterm in RULE_TABLES:
+			continue
+
+		RULE_TABLES[nonterm] = rules = compile_rules(nonterm)
+		for syms, _ in rules:
+			for sym in syms:
+				if sym.is_many:
+					sym = sym.sym
+				if not sym.is_terminal:
+					pending.append(sym)
+
+
+def parse_nonterm(nonterm, tokens, start, memo=None):
+	"""Parse a nonterminal from tokens[start:]
+
+	Return (end, value), or None if none of its rules match at start.
+	"""
+	if memo is not None:
+		key = (nonterm, start)
+		if key in memo:
+			if STATS is not None:
+				STATS.memo_hits += 1
+			return memo[key]
+
+	try:
+		rules = RULE_TABLES[nonterm]
+	except KeyError:
+		compile_grammar(nonterm)
+		rules = RULE_TABLES[nonterm]
+
+	res = None
+	for syms, cb in rules:
+		res = parse_rule(syms, tokens, start, memo)
+		if res is not None:
+			end, parts = res
+			res = end, cb(*parts)
 			break
-	else:
-		raise BadSymbol()
-	return start, cb(*parts)
+
+	if memo is not None:
+		memo[key] = res
+	return res
 
 
-def do_parser(entry, tokens):
-	start, ast = parse_nonterm(entry, tokens, 0)
+def do_parser(entry, tokens, memoize=False):
+	"""Parse tokens as an entry nonterminal and return the AST
+
+	If memoize is true, parse in packrat mode: the result of parsing each
+	nonterminal at each token index is remembered, so no (nonterminal, index)
+	pair is parsed twice when backtracking, and parsing time is linear.
+	"""
+	memo = {} if memoize else None
+	res = parse_nonterm(entry, tokens, 0, memo)
+	if res is None:
+		if tokens:
+			raise BadSymbol(token=tokens[0])
+		raise BadSymbol(pos=0, text='')
+
+	start, ast = res
 	if start < len(tokens):
 		raise ExtraTokensError(token=tokens[start])
 	return ast
@@ -284,20 +696,22 @@ def do_parser(entry, tokens):
 
 @register
 class Number(Terminal):
+	__slots__ = ('n',)
 	type = 'number'
-	re = re.compile(r'(?P<number>-?\d+(?:\.\d*)?)')
+	re = LazyRegex(r'(?P<number>-?\d+(?:\.\d*)?)')
 
-	def __init__(self, d=None, match=None, n=None):
-		super(Number, self).__init__(d, match)
-		if n is not None:
-			self.n = n
-		else:
-			try:
-				self.n = int(self.d['number'])
-			except ValueError:
-				self.n = float(self.d['number'])
+	def __init__(self, text=None, start=0, end=0, n=None):
+		super(Number, self).__init__(text, start, end)
+		self.n = n
 
 	def value(self):
+		if self.n is None:
+			# the whole token is the number
+			number = self.group()
+			try:
+				self.n = int(number)
+			except ValueError:
+				self.n = float(number)
 		return self.n
 
 	def __add__(self, other):
@@ -332,7 +746,8 @@ class Number(Terminal):
 
 @register
 class Unit(Terminal):
-	re = re.compile(
+	__slots__ = ()
+	re = LazyRegex(
 	'(?P<microseconds>microseconds?|us)|'
 	'(?P<milliseconds>milliseconds?|ms)|'
 	'(?P<seconds>seconds?|secs?|s)|'
@@ -344,32 +759,43 @@ class Unit(Terminal):
 	'(?P<years>years?|yrs?|y)')
 
 	def value(self):
-		return next(iter(self.d.keys()))
+		# unit groups are not nested, so the last group is the only one
+		return self.match.lastgroup
 
 
 @register
 class DatetimeLiteral(Terminal):
-	re = re.compile('(?P<lit>now|epoch)')
+	__slots__ = ()
+	re = LazyRegex('(?P<lit>now|epoch)')
 
 	def value(self):
-		if self.d['lit'] == 'now':
+		lit = self.group()
+		if lit == 'now':
 			return datetime.datetime.now()
-		elif self.d['lit'] == 'epoch':
+		elif lit == 'epoch':
 			return datetime.datetime(1970, 1, 1)
 
+	def is_time_dependent(self):
+		return self.group() == 'now'
+
 
 @register
 class DateLiteral(Terminal):
-	re = re.compile('(?P<lit>today)')
+	__slots__ = ()
+	re = LazyRegex('(?P<lit>today)')
 
 	def value(self):
-		if self.d['lit'] == 'today':
+		if self.group() == 'today':
 			return datetime.date.today()
 
+	def is_time_dependent(self):
+		return True
+
 
 @register
 class ISO8601(Terminal):
-	re = re.compile(r'''(?P<year>\d{4})(?P<datesep>-?)
+	__slots__ = ()
+	re = LazyRegex(r'''(?P<year>\d{4})(?P<datesep>-?)
 	(?:
 		(?P<month>\d{2})(?P=datesep)(?P<day>\d{2})|
 		(?P<yearday>\d{3})|
@@ -381,24 +807,37 @@ class ISO8601(Terminal):
 	)?''', re.X)
 
 	def _value(self):
-		year = int(self.d.get('year', 0))
-		if 'month' in self.d:
-			month = int(self.d.get('month', 0))
-			day = int(self.d.get('day', 0))
-			date = datetime.date(year, month, day)
-		elif 'yearday' in self.d:
-			yearday = int(self.d.get('yearday', 0))
-			date = datetime.date(year, 1, 1) + datetime.timedelta(days=yearday - 1)
-		elif 'week' in self.d:
-			week = int(self.d.get('week', 0))
-			weekday = int(self.d.get('weekday'))
+		text = self.group()
+		n = len(text)
+		if n in (10, 16, 19) and text[4] == text[7] == '-' and (n == 10 or text[10] in ' T' and text[13] == ':' and (n == 16 or text[16] == ':')):
+			# fast path for YYYY-MM-DD[( |T)HH:MM[:SS]]
+			return datetime.datetime(
+				int(text[:4]), int(text[5:7]), int(text[8:10]),
+				int(text[11:13] or 0), int(text[14:16] or 0), int(text[17:19] or 0),
+			)
+		elif n in (13, 15) and text[8] == 'T' and text[4] not in '-W':
+			# fast path for YYYYMMDDTHHMM[SS]
+			return datetime.datetime(
+				int(text[:4]), int(text[4:6]), int(text[6:8]),
+				int(text[9:11]), int(text[11:13]), int(text[13:15] or 0),
+			)
+
+		year, month, day, yearday, week, weekday, hour, minute, second = self.groups(
+			'year', 'month', 'day', 'yearday', 'week', 'weekday', 'hour', 'minute', 'second',
+		)
+		year = int(year)
+		if month is not None:
+			date = datetime.date(year, int(month), int(day))
+		elif yearday is not None:
+			date = datetime.date(year, 1, 1) + datetime.timedelta(days=int(yearday) - 1)
+		elif week is not None:
 			date = datetime.date(year, 1, 1)
-			date += datetime.timedelta(days=(week - 1) * 7)
-			date += datetime.timedelta(days=weekday - date.isoweekday())
+			date += datetime.timedelta(days=(int(week) - 1) * 7)
+			date += datetime.timedelta(days=int(weekday) - date.isoweekday())
 
-		hour = int(self.d.get('hour', 0))
-		minute = int(self.d.get('minute', 0))
-		second = int(self.d.get('second', 0))
+		hour = int(hour or 0)
+		minute = int(minute or 0)
+		second = int(second or 0)
 		time = datetime.time(hour, minute, second)
 
 		return datetime.datetime.combine(date, time)
@@ -412,12 +851,16 @@ class ISO8601(Terminal):
 
 @register
 class Date(Terminal):
-	re = re.compile(r'(?P<year>\d{2,4})(?P<_datesep>[/-]?)(?P<month>\d{1,2})(?P=_datesep)(?P<day>\d{1,2})')
+	__slots__ = ()
+	re = LazyRegex(r'(?P<year>\d{2,4})(?P<_datesep>[/-]?)(?P<month>\d{1,2})(?P=_datesep)(?P<day>\d{1,2})')
 
 	def _value(self):
-		y = int(self.d.get('year'))
-		m = int(self.d.get('month'))
-		d = int(self.d.get('day'))
+		text = self.group()
+		if len(text) == 10 and text[4] == text[7] == '/':
+			# fast path for YYYY/MM/DD
+			return datetime.date(int(text[:4]), int(text[5:7]), int(text[8:10]))
+
+		y, m, d = map(int, self.groups('year', 'month', 'day'))
 		return datetime.date(y, m, d)
 
 	def value(self):
@@ -429,7 +872,8 @@ class Date(Terminal):
 
 @register
 class Time(Terminal):
-	re = re.compile(r'''(?P<hour>\d{1,2})
+	__slots__ = ()
+	re = LazyRegex(r'''(?P<hour>\d{1,2})
 	(?:
 		(?P<_timesep>[:.])
 		(?P<minute>\d{2})
@@ -447,12 +891,18 @@ class Time(Terminal):
 	)''', re.X)
 
 	def _value(self):
-		h = int(self.d.get('hour', 0))
-		m = int(self.d.get('minute', 0))
-		s = int(self.d.get('second', 0))
-		ms = int(self.d.get('millisecond', 0))
-		us = int(self.d.get('microsecond', 0))
-		ampm = self.d.get('ampm')
+		text = self.group()
+		n = len(text)
+		if n in (5, 8) and text[2] == ':' and (n == 5 or text[5] == ':'):
+			# fast path for HH:MM[:SS]
+			return datetime.time(int(text[:2]), int(text[3:5]), int(text[6:8] or 0))
+
+		h, m, s, ms, us, ampm = self.groups('hour', 'minute', 'second', 'millisecond', 'microsecond', 'ampm')
+		h = int(h or 0)
+		m = int(m or 0)
+		s = int(s or 0)
+		ms = int(ms or 0)
+		us = int(us or 0)
 		if ampm:
 			if ampm == 'am' and h == 12:
 				h = 0
@@ -467,6 +917,16 @@ class Time(Terminal):
 			raise InvalidDate(token=self, exc=e)
 
 
+@register
+class Variable(Terminal):
+	__slots__ = ()
+	re = LazyRegex(r'\$(?P<name>\w+)')
+
+	def value(self):
+		# skip the "$"
+		return self.text[self.start + 1:self.end]
+
+
 Comma = register(create_terminal(','))
 
 OpenParen = register(create_terminal(r'\('))
@@ -475,7 +935,8 @@ CloseParen = register(create_terminal(r'\)'))
 
 @register
 class Minus(Terminal):
-	re = re.compile('-')
+	__slots__ = ()
+	re = LazyRegex('-')
 
 	@staticmethod
 	def apply(left, right):
@@ -484,7 +945,8 @@ class Minus(Terminal):
 
 @register
 class Plus(Terminal):
-	re = re.compile(r'\+')
+	__slots__ = ()
+	re = LazyRegex(r'\+')
 
 	@staticmethod
 	def apply(left, right):
@@ -493,7 +955,8 @@ class Plus(Terminal):
 
 @register
 class Multiplication(Terminal):
-	re = re.compile(r'\*')
+	__slots__ = ()
+	re = LazyRegex(r'\*')
 
 	@staticmethod
 	def apply(left, right):
@@ -502,7 +965,8 @@ class Multiplication(Terminal):
 
 @register
 class Division(Terminal):
-	re = re.compile('/')
+	__slots__ = ()
+	re = LazyRegex('/')
 
 	@staticmethod
 	def apply(left, right):
@@ -511,7 +975,8 @@ class Division(Terminal):
 
 @register
 class Whitespace(Terminal):
-	re = re.compile(r'\s+')
+	__slots__ = ()
+	re = LazyRegex(r'\s+')
 	ignore = True
 
 
@@ -524,13 +989,9 @@ class DurationPart(NonTerminal):
 
 @register
 class DurationEx(NonTerminal):
-	@rule(Comma, DurationPart, Lazy('DurationEx'))
-	def r0(_, part, rest):
-		return [part] + rest
-
-	@rule()
-	def r1():
-		return []
+	@rule(Comma, DurationPart)
+	def r(_, part):
+		return part
 
 
 class BaseDuration(object):
@@ -538,43 +999,13 @@ class BaseDuration(object):
 
 	@classmethod
 	def create(cls, parts):
-		return cls(cls.parts2delta(parts))
+		items = cls.parts2items(parts)
+		if 'years' in items or 'months' in items:
+			return RelativedeltaDuration(relativedelta(**items))
+		return TimedeltaDuration.from_items(items)
 
-	def __init__(self, delta):
-		self.delta = delta
-
-	def __add__(self, other):
-		if other.type == 'duration':
-			return Duration(self.delta + other.delta)
-		elif other.type == 'datetime':
-			return NotImplemented
-		raise TypeError()
-
-	__radd__ = __add__
-
-	def __sub__(self, other):
-		if other.type == 'duration':
-			return Duration(self.delta - other.delta)
-		raise TypeError()
-
-	def __repr__(self):
-		return repr(self.delta2parts(self.delta))
-
-	def __str__(self):
-		items = self.delta2parts(self.delta)
-		parts = [self._plural(items[k], k) for k in items if items[k]]
-		return ', '.join(parts) or '0 seconds'
-
-	@staticmethod
-	def _plural(val, unit):
-		if val == 1:
-			unit = unit[:-1]
-		return '%s %s' % (val, unit)
-
-
-class RelativedeltaDuration(BaseDuration):
 	@classmethod
-	def parts2delta(cls, parts):
+	def parts2items(cls, parts):
 		items = {}
 		for n, u in parts:
 			if u.value() in items:
@@ -585,15 +1016,18 @@ class RelativedeltaDuration(BaseDuration):
 			items.setdefault('microseconds', 0)
 			items['microseconds'] += items.pop('milliseconds') * 1000
 
-		return relativedelta(**items)
+		return items
 
 	KEYS = ('years', 'months', 'days', 'hours', 'minutes', 'seconds', 'microseconds')
 
 	@classmethod
 	def delta2parts(cls, delta):
+		return cls.items2parts((k, getattr(delta, k, 0)) for k in cls.KEYS)
+
+	@staticmethod
+	def items2parts(pairs):
 		items = OrderedDict()
-		for k in cls.KEYS:
-			v = getattr(delta, k, 0)
+		for k, v in pairs:
 			if v:
 				items[k] = v
 
@@ -603,45 +1037,247 @@ class RelativedeltaDuration(BaseDuration):
 
 		return items
 
+	def __init__(self, delta):
+		self.delta = delta
+
+	def parts(self):
+		return self.delta2parts(self.delta)
+
+	def __add__(self, other):
+		if other.type == 'duration':
+			return make_duration(self.delta + other.delta)
+		elif other.type == 'datetime':
+			return NotImplemented
+		raise TypeError()
+
+	__radd__ = __add__
+
+	def __sub__(self, other):
+		if other.type == 'duration':
+			return make_duration(self.delta - other.delta)
+		raise TypeError()
+
+	def __truediv__(self, other):
+		if other.type == 'duration':
+			factor = self.to_timedelta().total_seconds() / other.to_timedelta().total_seconds()
+			return Number(n=factor)
+		elif other.type == 'number':
+			return self * (Number(n=1) / other)
+		raise TypeError()
+
+	def __repr__(self):
+		return repr(self.parts())
+
+	def __str__(self):
+		return self.format_items((k, getattr(self.delta, k, 0)) for k in self.KEYS)
+
+	# singular and plural of the units, indexed by their plural
+	UNIT_NAMES = {unit: (unit[:-1], unit) for unit in KEYS + ('milliseconds',)}
+
+	@classmethod
+	def format_items(cls, pairs):
+		"""Return the text of (unit, value) pairs, like str(items2parts(pairs)) would"""
+		names = cls.UNIT_NAMES
+		parts = []
+		for k, v in pairs:
+			if not v:
+				continue
+			if k == 'microseconds' and not v % 1000:
+				k, v = 'milliseconds', v // 1000
+			singular, plural = names[k]
+			parts.append('%s %s' % (v, singular if v == 1 else plural))
+		return ', '.join(parts) or '0 seconds'
+
+
+class RelativedeltaDuration(BaseDuration):
 	def to_timedelta(self):
 		days = self.delta.days + self.delta.months * 30 + self.delta.years * 365
 		secs = self.delta.seconds + self.delta.minutes * 60 + self.delta.hours * 3600
 		usecs = self.delta.microseconds
 		return datetime.timedelta(days=days, seconds=secs, microseconds=usecs)
 
+	def calendar_parts(self):
+		"""Return the months (including years) and the fixed-length timedelta"""
+		delta = self.delta
+		fixed = datetime.timedelta(
+			days=delta.days, hours=delta.hours, minutes=delta.minutes,
+			seconds=delta.seconds, microseconds=delta.microseconds,
+		)
+		return delta.years * 12 + delta.months, fixed
+
+	def add_to(self, dt):
+		return dt + self.delta
+
+	def subtract_from(self, dt):
+		return dt - self.delta
+
 	def __mul__(self, other):
 		if other.type == 'number':
 			other = other.value()
 			if int(other) == int:
-				return RelativedeltaDuration(self.delta * other)
+				return make_duration(self.delta * other)
 			else:
 				d = {k: getattr(self.delta, k) * other for k in self.KEYS}
-				return RelativedeltaDuration(relativedelta(**d).normalized())
+				return make_duration(relativedelta(**d).normalized())
 		raise TypeError()
 
 	__rmul__ = __mul__
 
-	def __truediv__(self, other):
-		if other.type == 'duration':
-			factor = self.to_timedelta().total_seconds() / other.to_timedelta().total_seconds()
-			return Number(n=factor)
-		elif other.type == 'number':
-			return self * (Number(n=1) / other)
+	def approx(self):
+		return TimedeltaDuration.from_timedelta(self.to_timedelta())
+
+
+def _sign(x):
+	return int(math.copysign(1, x))
+
+
+class TimedeltaDuration(BaseDuration):
+	"""Duration without months or years
+
+	Fixed-length units don't need relativedelta: the fields relativedelta
+	would have (days to microseconds) are kept in a plain tuple, normalized
+	like relativedelta does so the duration prints the same, and the
+	duration is added to datetimes as a timedelta.
+	"""
+
+	FIELDS = ('days', 'hours', 'minutes', 'seconds', 'microseconds')
+
+	def __init__(self, fields):
+		self.fields = fields
+
+	@classmethod
+	def from_items(cls, items):
+		return cls(cls.fix(
+			items.get('days', 0) + items.get('weeks', 0) * 7, items.get('hours', 0),
+			items.get('minutes', 0), items.get('seconds', 0), items.get('microseconds', 0),
+		))
+
+	@classmethod
+	def from_timedelta(cls, delta):
+		return cls(cls.fix(delta.days, 0, 0, delta.seconds, delta.microseconds))
+
+	@staticmethod
+	def fix(days, hours, minutes, seconds, microseconds):
+		"""Normalize fields like relativedelta._fix"""
+		if abs(microseconds) > 999999:
+			s = _sign(microseconds)
+			div, mod = divmod(microseconds * s, 1000000)
+			microseconds = mod * s
+			seconds += div * s
+		if abs(seconds) > 59:
+			s = _sign(seconds)
+			div, mod = divmod(seconds * s, 60)
+			seconds = mod * s
+			minutes += div * s
+		if abs(minutes) > 59:
+			s = _sign(minutes)
+			div, mod = divmod(minutes * s, 60)
+			minutes = mod * s
+			hours += div * s
+		if abs(hours) > 23:
+			s = _sign(hours)
+			div, mod = divmod(hours * s, 24)
+			hours = mod * s
+			days += div * s
+		return (days, hours, minutes, seconds, microseconds)
+
+	@classmethod
+	def normalized(cls, fields):
+		"""Cascade fractional fields down, like relativedelta.normalized"""
+		days, hours, minutes, seconds, microseconds = cls.fix(*fields)
+
+		int_days = int(days)
+		hours_f = round(hours + 24 * (days - int_days), 11)
+		int_hours = int(hours_f)
+		minutes_f = round(minutes + 60 * (hours_f - int_hours), 10)
+		int_minutes = int(minutes_f)
+		seconds_f = round(seconds + 60 * (minutes_f - int_minutes), 8)
+		int_seconds = int(seconds_f)
+		microseconds = round(microseconds + 1e6 * (seconds_f - int_seconds))
+		return cls.fix(int_days, int_hours, int_minutes, int_seconds, microseconds)
+
+	@property
+	def delta(self):
+		days, hours, minutes, seconds, microseconds = self.fields
+		return relativedelta(days=days, hours=hours, minutes=minutes, seconds=seconds, microseconds=microseconds)
+
+	def parts(self):
+		return self.items2parts(zip(self.FIELDS, self.fields))
+
+	def __str__(self):
+		return self.format_items(zip(self.FIELDS, self.fields))
+
+	def to_timedelta(self):
+		days, hours, minutes, seconds, microseconds = self.fields
+		secs = seconds + minutes * 60 + hours * 3600
+		return datetime.timedelta(days=days, seconds=secs, microseconds=microseconds)
+
+	def calendar_parts(self):
+		return 0, self.to_timedelta()
+
+	def add_to(self, dt):
+		return dt + self.to_timedelta()
+
+	def subtract_from(self, dt):
+		return dt - self.to_timedelta()
+
+	def __add__(self, other):
+		if isinstance(other, TimedeltaDuration):
+			return TimedeltaDuration(self.fix(*[a + b for a, b in zip(self.fields, other.fields)]))
+		return BaseDuration.__add__(self, other)
+
+	__radd__ = __add__
+
+	def __sub__(self, other):
+		if isinstance(other, TimedeltaDuration):
+			return TimedeltaDuration(self.fix(*[a - b for a, b in zip(self.fields, other.fields)]))
+		return BaseDuration.__sub__(self, other)
+
+	def __mul__(self, other):
+		if other.type == 'number':
+			other = other.value()
+			return TimedeltaDuration(self.normalized([v * other for v in self.fields]))
 		raise TypeError()
 
+	__rmul__ = __mul__
+
 	def approx(self):
-		delta = self.to_timedelta()
-		return RelativedeltaDuration(relativedelta(days=delta.days, seconds=delta.seconds, microseconds=delta.microseconds))
+		return TimedeltaDuration.from_timedelta(self.to_timedelta())
+
+
+def make_duration(delta):
+	"""Wrap a relativedelta, only keeping it if it has months or years"""
+	if delta.years or delta.months:
+		return RelativedeltaDuration(delta)
+	return TimedeltaDuration((delta.days, delta.hours, delta.minutes, delta.seconds, delta.microseconds))
 
 
 Duration = RelativedeltaDuration
 
 
+class Deferred(object):
+	"""AST leaf computed by do_compute instead of by the parser
+
+	Used for values depending on the current time, like "now" or "today", so
+	an AST can be evaluated again later.
+	"""
+
+	def __init__(self, func, *args):
+		self.func = func
+		self.args = args
+
+	def __repr__(self):
+		return '<Deferred %s%r>' % (self.func.__name__, self.args)
+
+	def compute(self):
+		return self.func(*self.args)
+
+
 @register
 class DatetimeEx1(NonTerminal):
 	@rule(Time)
 	def r0(t):
-		return t.value()
+		return t
 
 	@rule()
 	def r1():
@@ -652,11 +1288,11 @@ class DatetimeEx1(NonTerminal):
 class DatetimeEx2(NonTerminal):
 	@rule(Date)
 	def r0(d):
-		return d.value()
+		return d
 
 	@rule(DateLiteral)
 	def r0b(d):
-		return d.value()
+		return d
 
 	@rule()
 	def r1():
@@ -669,23 +1305,43 @@ class Datetime(NonTerminal):
 
 	@rule(DatetimeLiteral)
 	def r0(d):
-		return Datetime(d.value())
+		return Datetime.create(d, None)
 
 	@rule(ISO8601)
 	def r0b(d):
-		return Datetime(d.value())
+		return Datetime.create(d, None)
 
 	@rule(Date, DatetimeEx1)
 	def r1(d, rest):
-		return Datetime(Datetime.combine(d.value(), rest))
+		return Datetime.create(d, rest)
 
 	@rule(DateLiteral, DatetimeEx1)
 	def r1b(d, rest):
-		return Datetime(Datetime.combine(d.value(), rest))
+		return Datetime.create(d, rest)
 
 	@rule(Time, DatetimeEx2)
 	def r2(t, rest):
-		return Datetime(Datetime.combine(rest, t.value()))
+		return Datetime.create(rest, t)
+
+	@classmethod
+	def create(cls, date, time):
+		"""Build a Datetime from date and time tokens, which can be None
+
+		If the result depends on the current time, it is deferred to do_compute.
+		"""
+		if date is None or date.is_time_dependent():
+			return Deferred(cls.from_tokens, date, time)
+		return cls.from_tokens(date, time)
+
+	@classmethod
+	def from_tokens(cls, date, time):
+		if date is not None:
+			date = date.value()
+			if isinstance(date, datetime.datetime):
+				return cls(date)
+		if time is not None:
+			time = time.value()
+		return cls(cls.combine(date, time))
 
 	@staticmethod
 	def combine(date, time):
@@ -706,7 +1362,7 @@ class Datetime(NonTerminal):
 
 	def __add__(self, other):
 		if other.type == 'duration':
-			dt = self.datetime + other.delta
+			dt = other.add_to(self.datetime)
 			return Datetime(dt)
 		raise TypeError()
 
@@ -714,16 +1370,20 @@ class Datetime(NonTerminal):
 
 	def __sub__(self, other):
 		if other.type == 'duration':
-			dt = self.datetime - other.delta
+			dt = other.subtract_from(self.datetime)
 			return Datetime(dt)
 		elif other.type == 'datetime':
+			if (self.datetime.year, self.datetime.month) == (other.datetime.year, other.datetime.month):
+				# relativedelta would find no months in between
+				delta = self.datetime - other.datetime
+				return TimedeltaDuration(TimedeltaDuration.fix(0, 0, 0, delta.days * 86400 + delta.seconds, delta.microseconds))
 			delta = relativedelta(self.datetime, other.datetime)
-			return Duration(delta)
+			return make_duration(delta)
 		raise TypeError()
 
 
 class NumDuration(NonTerminal):
-	@rule(Unit, DurationEx)
+	@rule(Unit, Many(DurationEx))
 	def r0(u, rest):
 		return (u, rest)
 
@@ -744,64 +1404,64 @@ class Factor(NonTerminal):
 			return n
 		else:
 			u, rest = rest
-			return Duration.create([(n, u)] + rest)
+			return BaseDuration.create([(n, u)] + rest)
 
 	@rule(OpenParen, Lazy('Expression'), CloseParen)
 	def r2(_, expr, __):
 		return expr
 
+	@rule(Variable)
+	def r3(v):
+		return v
+
 
 @register
-class TermD(NonTerminal):
-	@rule(Multiplication, Factor, Lazy('TermD'))
-	def r0_m(op, right, rest):
-		return [op, right, rest]
+class TermOp(NonTerminal):
+	@rule(Multiplication, Factor)
+	def r0_m(op, right):
+		return (op, right)
 
-	@rule(Division, Factor, Lazy('TermD'))
-	def r0_d(op, right, rest):
-		return [op, right, rest]
+	@rule(Division, Factor)
+	def r0_d(op, right):
+		return (op, right)
 
-	@rule()
-	def r1():
-		pass
 
+class BinOp(namedtuple('BinOp', ('op', 'left', 'right'))):
+	"""AST node of a binary operation, op being the operator token"""
 
-def make_ast_lr(left, rest):
-	if not rest:
-		return left
+	__slots__ = ()
 
-	op, right, rest = rest
-	left = [op, left, right]
-	return make_ast_lr(left, rest)
+
+def make_ast_lr(left, ops):
+	"""Build a left-associative AST from the first operand and (op, operand) pairs"""
+	for op, right in ops:
+		left = BinOp(op, left, right)
+	return left
 
 
 @register
 class Term(NonTerminal):
-	@rule(Factor, TermD)
-	def r(left, ted):
-		return make_ast_lr(left, ted)
+	@rule(Factor, Many(TermOp))
+	def r(left, ops):
+		return make_ast_lr(left, ops)
 
 
 @register
-class ExpressionD(NonTerminal):
-	@rule(Plus, Term, Lazy('ExpressionD'))
-	def r0_p(op, right, rest):
-		return [op, right, rest]
-
-	@rule(Minus, Term, Lazy('ExpressionD'))
-	def r0_m(op, right, rest):
-		return [op, right, rest]
+class ExpressionOp(NonTerminal):
+	@rule(Plus, Term)
+	def r0_p(op, right):
+		return (op, right)
 
-	@rule()
-	def r1():
-		pass
+	@rule(Minus, Term)
+	def r0_m(op, right):
+		return (op, right)
 
 
 @register
 class Expression(NonTerminal):
-	@rule(Term, ExpressionD)
-	def r(left, exd):
-		return make_ast_lr(left, exd)
+	@rule(Term, Many(ExpressionOp))
+	def r(left, ops):
+		return make_ast_lr(left, ops)
 
 
 GRAMMAR_ENTRY = Expression
@@ -814,34 +1474,619 @@ class InvalidDate(ParserException):
 class BadOperand(ParserException):
 	def __init__(self, op, left, right):
 		ParserException.__init__(self, token=op)
-		self.reason = "Bad operands for '%s'" % op.match.group()
+		self.reason = "Bad operands for '%s'" % op.group()
 
 
 class DuplicateUnit(ParserException):
 	reason = 'Unit is already used'
 
+
+class UnboundVariable(ParserException):
+	reason = 'Variable has no value'
+
 # }}}
-# {{{ chronocalc main
+# {{{ vectorized evaluation
+
+class NotVectorizable(Exception):
+	pass
+
+
+class VectorValue(object):
+	"""Column of chronocalc values of a single type, as NumPy arrays
 
-def do_compute(ast):
-	if isinstance(ast, list):
-		op, left, right = ast
-		left = do_compute(left)
-		right = do_compute(right)
+	Datetimes are datetime64[us] arrays, numbers are numeric arrays.
+	Durations are split like relativedelta: integer arrays of years and
+	months, kept apart as relativedelta does (1 year, -1 month is not 11
+	months), and a timedelta64[us] array of the fixed-length units.
+	"""
 
+	def __init__(self, type, values, years=0, months=0):
+		self.type = type
+		self.values = values
+		self.years = years
+		self.months = months
+
+	@property
+	def total_months(self):
+		return self.years * 12 + self.months
+
+
+class VectorEvaluator(object):
+	"""Evaluate ASTs over NumPy arrays, with the semantics of do_compute"""
+
+	def __init__(self):
+		import numpy
+
+		self.np = numpy
+		self.one_day = numpy.timedelta64(86400 * 10 ** 6, 'us')
+		self.min_datetime = numpy.datetime64('0001-01-01', 'us')
+		self.max_datetime = numpy.datetime64('10000-01-01', 'us')
+
+	def evaluate(self, ast, bindings):
+		variables = {name: self.bind(value) for name, value in bindings.items()}
 		try:
-			res = op.apply(left, right)
-		except TypeError as e:
-			raise BadOperand(op, left, right) from e
+			return self.unpack(self.compute(ast, variables))
+		except NotVectorizable:
+			return self.compute_rows(ast, bindings)
+
+	def compute(self, ast, variables):
+		def leaf(node):
+			if isinstance(node, Variable):
+				if node.value() not in variables:
+					raise UnboundVariable(token=node)
+				return variables[node.value()]
+			elif isinstance(node, Deferred):
+				return self.pack(node.compute())
+			return self.pack(node)
+
+		def apply(op, left, right):
+			res = self.apply(op, left, right)
+			if res is None:
+				raise BadOperand(op, left, right)
+			return res
+
+		return fold_ast(ast, leaf, apply)
+
+	def bind(self, value):
+		np = self.np
+
+		if isinstance(value, (list, tuple)):
+			value = np.asarray(value)
+		if not isinstance(value, (np.ndarray, np.generic)):
+			return self.pack(to_value(value))
+
+		kind = value.dtype.kind
+		if kind == 'M':
+			return VectorValue('datetime', value.astype('M8[us]'))
+		elif kind == 'm':
+			return VectorValue('duration', value.astype('m8[us]'))
+		elif kind in 'biuf':
+			return VectorValue('number', value)
+		raise NotVectorizable()
+
+	def pack(self, value):
+		np = self.np
+
+		if value.type == 'datetime':
+			return VectorValue('datetime', np.datetime64(value.datetime, 'us'))
+		elif value.type == 'number':
+			return VectorValue('number', np.asarray(value.value()))
+
+		years = months = 0
+		if isinstance(value, RelativedeltaDuration):
+			years, months = value.delta.years, value.delta.months
+		fixed = value.calendar_parts()[1]
+		return VectorValue('duration', np.timedelta64(fixed, 'us'), np.asarray(years), np.asarray(months))
+
+	def unpack(self, value):
+		np = self.np
+
+		if value.type != 'duration':
+			return np.asarray(value.values)
+
+		years, months, values = np.broadcast_arrays(value.years, value.months, value.values)
+		if not years.any() and not months.any():
+			return np.asarray(value.values)
+
+		res = np.empty(months.shape, dtype=object)
+		for idx in np.ndindex(months.shape):
+			# split like a timedelta, as relativedelta(dt1, dt2) does
+			seconds, microseconds = divmod(int(values[idx] // np.timedelta64(1, 'us')), 10 ** 6)
+			delta = relativedelta(
+				years=int(years[idx]), months=int(months[idx]),
+				seconds=seconds, microseconds=microseconds,
+			)
+			res[idx] = make_duration(delta)
 		return res
+
+	def compute_rows(self, ast, bindings):
+		"""Evaluate ast with do_compute for each row of the bindings"""
+		np = self.np
+
+		names = list(bindings)
+		columns = []
+		for name in names:
+			column = np.asarray(bindings[name])
+			if column.dtype.kind in 'Mm':
+				column = column.astype(column.dtype.kind + '8[us]')
+			columns.append(column)
+
+		columns = np.broadcast_arrays(*columns) if columns else []
+		shape = columns[0].shape if columns else ()
+
+		results = []
+		for idx in np.ndindex(shape):
+			variables = {name: to_value(column[idx].item()) for name, column in zip(names, columns)}
+			results.append(do_compute(ast, variables))
+
+		types = {res.type for res in results}
+		if types == {'datetime'}:
+			res = np.array([res.datetime for res in results], dtype='M8[us]')
+		elif types == {'number'}:
+			res = np.array([res.value() for res in results])
+		elif types == {'duration'} and not any(res.calendar_parts()[0] for res in results):
+			res = np.array([self.pack(res).values for res in results], dtype='m8[us]')
+		else:
+			res = np.empty(len(results), dtype=object)
+			res[:] = results
+		return res.reshape(shape)
+
+	def fix_months(self, years, months):
+		"""Carry months over 11 into years, like relativedelta._fix"""
+		np = self.np
+
+		sign = np.sign(months)
+		div, mod = np.divmod(np.abs(months), 12)
+		return years + div * sign, mod * sign
+
+	def check_range(self, dt):
+		"""Raise NotVectorizable if datetimes are outside of datetime's years"""
+		np = self.np
+
+		valid = dt[~np.isnat(dt)]
+		if (valid < self.min_datetime).any() or (valid >= self.max_datetime).any():
+			# the scalar path raises the right error
+			raise NotVectorizable()
+		return dt
+
+	def add_duration(self, dt, value, sign=1):
+		"""Add a duration to datetime64 values, like adding a relativedelta"""
+		dt = self.add_months(dt, sign * value.total_months)
+		# check before adding the fixed part, which could make it look valid again
+		self.check_range(dt)
+		return self.check_range(dt + sign * value.values)
+
+	def add_months(self, dt, months):
+		"""Add months to datetime64 values, clamping the day like relativedelta"""
+		np = self.np
+
+		if not np.any(months):
+			return dt
+
+		month = dt.astype('M8[M]')
+		day = (dt - month.astype('M8[us]')) // self.one_day
+		time = dt - month.astype('M8[us]') - day * self.one_day
+
+		month = month + months
+		month_len = ((month + 1).astype('M8[D]') - month.astype('M8[D]')).astype('i8')
+		day = np.minimum(day, month_len - 1)
+		return month.astype('M8[us]') + day * self.one_day + time
+
+	def diff(self, dt1, dt2):
+		"""Return the months and fixed-length parts of relativedelta(dt1, dt2)"""
+		np = self.np
+
+		months = dt1.astype('M8[M]').astype('i8') - dt2.astype('M8[M]').astype('i8')
+		backwards = dt1 < dt2
+		dtm = self.add_months(dt2, months)
+		while True:
+			overshot = np.where(backwards, dt1 > dtm, dt1 < dtm)
+			if not overshot.any():
+				break
+			months = months + np.where(overshot, np.where(backwards, 1, -1), 0)
+			dtm = self.add_months(dt2, months)
+		return months, dt1 - dtm
+
+	def approx_days(self, value):
+		# like RelativedeltaDuration.to_timedelta
+		return value.values / self.one_day + value.years * 365 + value.months * 30
+
+	def scale(self, value, factor):
+		np = self.np
+
+		factor = np.asarray(factor)
+		if not np.isfinite(factor).all():
+			raise NotVectorizable()
+
+		years = np.asarray(value.years) * factor
+		months = np.asarray(value.months) * factor
+		if factor.dtype.kind == 'f' and (np.any(years % 1) or np.any(months % 1)):
+			# relativedelta rejects non-integer years and months
+			raise NotVectorizable()
+
+		values = np.rint(value.values.astype('i8') * factor).astype('i8').astype('m8[us]')
+		years, months = self.fix_months(years.astype('i8'), months.astype('i8'))
+		return VectorValue('duration', values, years, months)
+
+	def apply(self, op, left, right):
+		np = self.np
+		types = (left.type, right.type)
+
+		if isinstance(op, Plus):
+			if types == ('number', 'number'):
+				return VectorValue('number', left.values + right.values)
+			elif types == ('duration', 'duration'):
+				years, months = self.fix_months(left.years + right.years, left.months + right.months)
+				return VectorValue('duration', left.values + right.values, years, months)
+			elif types == ('datetime', 'duration'):
+				return VectorValue('datetime', self.add_duration(left.values, right))
+			elif types == ('duration', 'datetime'):
+				return VectorValue('datetime', self.add_duration(right.values, left))
+
+		elif isinstance(op, Minus):
+			if types == ('number', 'number'):
+				return VectorValue('number', left.values - right.values)
+			elif types == ('duration', 'duration'):
+				years, months = self.fix_months(left.years - right.years, left.months - right.months)
+				return VectorValue('duration', left.values - right.values, years, months)
+			elif types == ('datetime', 'duration'):
+				return VectorValue('datetime', self.add_duration(left.values, right, -1))
+			elif types == ('datetime', 'datetime'):
+				months, values = self.diff(left.values, right.values)
+				years, months = self.fix_months(0, months)
+				return VectorValue('duration', values, years, months)
+
+		elif isinstance(op, Multiplication):
+			if types == ('number', 'number'):
+				return VectorValue('number', left.values * right.values)
+			elif types == ('duration', 'number'):
+				return self.scale(left, right.values)
+			elif types == ('number', 'duration'):
+				return self.scale(right, left.values)
+
+		elif isinstance(op, Division):
+			if types == ('number', 'number'):
+				if not np.all(right.values):
+					raise NotVectorizable()
+				return VectorValue('number', left.values / right.values)
+			elif types == ('duration', 'duration'):
+				divisor = self.approx_days(right)
+				if not np.all(divisor):
+					raise NotVectorizable()
+				return VectorValue('number', self.approx_days(left) / divisor)
+			elif types == ('duration', 'number'):
+				if not np.all(right.values):
+					raise NotVectorizable()
+				return self.scale(left, 1 / right.values)
+
+		else:
+			raise NotVectorizable()
+
+
+def evaluate_array(expr, **bindings):
+	"""Evaluate an expression over NumPy arrays at once
+
+	expr is a CompiledExpression or an AST returned by do_parser. Variables
+	are bound to datetime64, timedelta64 or numeric arrays, which are
+	broadcast together, or to scalars accepted by to_value().
+
+	Return a datetime64[us], timedelta64[us] or numeric array. Durations with
+	months or years can't be timedelta64, and are returned as an object array
+	of Duration. Operations that can't be vectorized, like division by zero,
+	are computed row by row with do_compute, giving the same results or errors.
+	"""
+	ast = getattr(expr, 'ast', expr)
+	return VectorEvaluator().evaluate(ast, bindings)
+
+# }}}
+# {{{ chronocalc main
+
+def iter_leaves(ast):
+	stack = [ast]
+	while stack:
+		node = stack.pop()
+		if isinstance(node, BinOp):
+			stack.append(node.right)
+			stack.append(node.left)
+		else:
+			yield node
+
+
+def to_value(obj):
+	"""Convert a Python object to a chronocalc value
+
+	Accepted are chronocalc values, datetimes, dates, timedeltas,
+	relativedeltas, numbers, and strings, which are evaluated as expressions.
+	"""
+	if isinstance(obj, (Number, BaseDuration, Datetime)):
+		return obj
+	elif isinstance(obj, datetime.datetime):
+		return Datetime(obj)
+	elif isinstance(obj, datetime.date):
+		return Datetime(Datetime.combine(obj, None))
+	elif isinstance(obj, datetime.timedelta):
+		return TimedeltaDuration.from_timedelta(obj)
+	elif is_relativedelta(obj):
+		return make_duration(obj)
+	elif isinstance(obj, (int, float)):
+		return Number(n=obj)
+	elif isinstance(obj, str):
+		return compute_from_string(obj)
+	raise TypeError('cannot convert %r to a chronocalc value' % type(obj).__name__)
+
+
+def fold_ast(ast, leaf, apply):
+	"""Compute an AST bottom-up, with an explicit stack instead of recursion
+
+	leaf(node) returns the value of a leaf, and apply(op, left, right) the
+	value of an operation on the values of its operands.
+	"""
+	values = []
+	pending = [(ast, False)]
+	while pending:
+		node, ready = pending.pop()
+		if ready:
+			right = values.pop()
+			values[-1] = apply(node.op, values[-1], right)
+		elif isinstance(node, BinOp):
+			pending.append((node, True))
+			pending.append((node.right, False))
+			pending.append((node.left, False))
+		else:
+			values.append(leaf(node))
+	return values[0]
+
+
+def do_compute(ast, variables=None):
+	# same walk as fold_ast, inlined as this is the hot path
+	values = []
+	pending = [(ast, False)]
+	while pending:
+		node, ready = pending.pop()
+		if ready:
+			right = values.pop()
+			values[-1] = apply_op(node.op, values[-1], right)
+		elif isinstance(node, BinOp):
+			pending.append((node, True))
+			pending.append((node.right, False))
+			pending.append((node.left, False))
+		elif isinstance(node, Deferred):
+			values.append(node.compute())
+		elif isinstance(node, Variable):
+			if variables is None or node.value() not in variables:
+				raise UnboundVariable(token=node)
+			values.append(variables[node.value()])
+		else:
+			values.append(node)
+	return values[0]
+
+
+def apply_op(op, left, right):
+	try:
+		return op.apply(left, right)
+	except TypeError as e:
+		raise BadOperand(op, left, right) from e
+
+
+class CompiledExpression(namedtuple('CompiledExpression', ('text', 'ast', 'variables', 'constant'))):
+	"""Parsed expression, which can be evaluated many times
+
+	Use compile() to create one. variables is the set of the names of the
+	variables ("$name") used in the expression. constant is true if the
+	expression has no variables and does not depend on the current time.
+	"""
+
+	__slots__ = ()
+
+	def evaluate(self, **bindings):
+		"""Compute the expression, with variables taking the values of bindings
+
+		Values are converted with to_value().
+		"""
+		variables = {name: to_value(value) for name, value in bindings.items()}
+		if STATS is None:
+			return do_compute(self.ast, variables)
+
+		start = time.perf_counter()
+		try:
+			return do_compute(self.ast, variables)
+		finally:
+			STATS.add_time('compute', start)
+
+
+def is_constant(node):
+	return not isinstance(node, (BinOp, Variable, Deferred))
+
+
+def optimize(ast):
+	"""Return ast with the operations on constant operands computed
+
+	Only variables, time-dependent values and the operations depending on
+	them are left to evaluate. Operations are not reordered: with months,
+	duration arithmetic is not associative. Operations which fail are kept,
+	so the error is raised when evaluating.
+	"""
+	def apply(op, left, right):
+		if is_constant(left) and is_constant(right):
+			try:
+				return op.apply(left, right)
+			except (TypeError,) + EVAL_ERRORS:
+				pass
+		return BinOp(op, left, right)
+
+	return fold_ast(ast, lambda node: node, apply)
+
+
+def compile(text, memoize=False):
+	"""Lex and parse text into a CompiledExpression
+
+	Constant parts of the expression are computed by optimize().
+	"""
+	if STATS is None:
+		ast = optimize(do_parser(GRAMMAR_ENTRY, do_lexer(text), memoize))
+	else:
+		start = time.perf_counter()
+		tokens = do_lexer(text)
+		STATS.add_time('lex', start)
+		STATS.tokens += len(tokens)
+
+		start = time.perf_counter()
+		ast = do_parser(GRAMMAR_ENTRY, tokens, memoize)
+		STATS.add_time('parse', start)
+
+		start = time.perf_counter()
+		ast = optimize(ast)
+		STATS.add_time('optimize', start)
+
+	variables = set()
+	constant = True
+	for leaf in iter_leaves(ast):
+		if isinstance(leaf, Variable):
+			variables.add(leaf.value())
+			constant = False
+		elif isinstance(leaf, Deferred):
+			constant = False
+	return CompiledExpression(text, ast, frozenset(variables), constant)
+
+
+CacheInfo = namedtuple('CacheInfo', ('hits', 'misses', 'maxsize', 'currsize'))
+
+
+class ExpressionCache(object):
+	"""LRU cache of compiled expressions, keyed by expression text
+
+	The result of constant expressions is cached too, and returned as is,
+	so it should not be modified. Other expressions are evaluated again from
+	their cached AST.
+	maxsize is the number of expressions kept, 0 disables the cache and None
+	makes it unbounded.
+	"""
+
+	def __init__(self, maxsize=128):
+		self.maxsize = maxsize
+		self.entries = OrderedDict()
+		self.hits = self.misses = 0
+
+	def info(self):
+		return CacheInfo(self.hits, self.misses, self.maxsize, len(self.entries))
+
+	def clear(self):
+		self.entries.clear()
+		self.hits = self.misses = 0
+
+	def resize(self, maxsize):
+		self.maxsize = maxsize
+		self.evict()
+
+	def evict(self):
+		if self.maxsize is None:
+			return
+		while len(self.entries) > self.maxsize:
+			try:
+				self.entries.popitem(last=False)
+			except KeyError:
+				break
+
+	def compute(self, text, memoize=False):
+		if self.maxsize == 0:
+			self.misses += 1
+			if STATS is not None:
+				STATS.cache_misses += 1
+			return compile(text, memoize).evaluate()
+
+		# pop and reinsert instead of move_to_end, so concurrent eviction
+		# cannot make the lookup fail
+		entry = self.entries.pop(text, None)
+		if entry is None:
+			self.misses += 1
+			if STATS is not None:
+				STATS.cache_misses += 1
+			entry = [compile(text, memoize), None]
+		else:
+			self.hits += 1
+			if STATS is not None:
+				STATS.cache_hits += 1
+		self.entries[text] = entry
+		self.evict()
+
+		compiled, result = entry
+		if result is not None:
+			return result
+
+		result = compiled.evaluate()
+		if compiled.constant:
+			entry[1] = result
+		return result
+
+
+CACHE = ExpressionCache()
+
+
+def compute_from_string(text, memoize=False):
+	return CACHE.compute(text, memoize)
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def epoch_us(v):
+	"""Return a datetime as microseconds since the epoch, a duration in microseconds
+
+	Months and years of durations count as 30 and 365 days, like approx().
+	Numbers are returned as is.
+	"""
+	if v.type == 'datetime':
+		return (v.datetime - EPOCH) // MICROSECOND
+	elif v.type == 'duration':
+		return v.to_timedelta() // MICROSECOND
+	return v.value()
+
+
+def json_result(v):
+	"""Return a value as a JSON object, exact durations being months and microseconds"""
+	import json
+
+	if v.type == 'datetime':
+		data = {'type': 'datetime', 'value': v.datetime.isoformat()}
+	elif v.type == 'duration':
+		months, fixed = v.calendar_parts()
+		data = {'type': 'duration', 'months': months, 'microseconds': fixed // MICROSECOND}
 	else:
-		return ast
+		data = {'type': 'number', 'value': v.value()}
+	return json.dumps(data)
+
+
+@functools.lru_cache(maxsize=4096)
+def format_microseconds(us):
+	"""Return the text of TimedeltaDuration.from_timedelta(timedelta(microseconds=us))
+
+	Integers are split like timedelta does, without building the duration.
+	Results are memoized, as many durations are printed over and over.
+	"""
+	days, us = divmod(us, 86400 * 10 ** 6)
+	seconds, us = divmod(us, 10 ** 6)
+	fields = TimedeltaDuration.fix(days, 0, 0, seconds, us)
+	return TimedeltaDuration.format_items(zip(TimedeltaDuration.FIELDS, fields))
+
 
+def format_result(v, **kwargs):
+	"""Format a value for output_format (default "text")
 
-def compute_from_string(text):
-	tokens = do_lexer(text)
-	ast = do_parser(GRAMMAR_ENTRY, tokens)
-	return do_compute(ast)
+	"npy" gives a (type, epoch_us(v)) pair, for write_npy().
+	"""
+	output_format = kwargs.get('output_format') or 'text'
+	if output_format == 'jsonl':
+		return json_result(v)
+	elif output_format == 'epoch-us':
+		return str(epoch_us(v))
+	elif output_format == 'npy':
+		return v.type, epoch_us(v)
+
+	if v.type == 'duration' and not kwargs.get('exact_durations', False):
+		# same as str(v.approx())
+		return format_microseconds(v.to_timedelta() // MICROSECOND)
+	return str(v)
 
 
 def do_one(text, **kwargs):
@@ -850,9 +2095,613 @@ def do_one(text, **kwargs):
 	except ParserException as e:
 		print(e)
 	else:
-		if v.type == 'duration' and not kwargs.get('exact_durations', False):
-			v = v.approx()
-		print(v)
+		print(format_result(v, **kwargs))
+
+
+# errors of an expression which should not stop a batch; the parser
+# recurses on parentheses, so deeply nested ones exceed the recursion limit
+EVAL_ERRORS = (ParserException, ArithmeticError, ValueError, RecursionError)
+
+
+def evaluate_lines(lines, **kwargs):
+	"""Evaluate expressions, one per line
+
+	Yield a (result, error) pair for each line: the formatted result and None,
+	or an empty string and the exception if the expression failed. Blank
+	lines give empty results.
+	"""
+	for line in lines:
+		text = line.rstrip('\r\n')
+		if not text or text.isspace():
+			yield '', None
+			continue
+
+		try:
+			result = format_result(compute_from_string(text), **kwargs)
+		except EVAL_ERRORS as e:
+			yield '', e
+		else:
+			yield result, None
+
+
+def warm_up():
+	"""Prepare the lexer and grammar tables, so the first evaluation is fast"""
+	get_lexer()
+	compile_grammar(GRAMMAR_ENTRY)
+
+
+def evaluate_chunk(lines, kwargs):
+	# errors are only printed, send their message rather than the exception
+	# with its tokens and text
+	return [
+		(result, None if error is None else str(error))
+		for result, error in evaluate_lines(lines, **kwargs)
+	]
+
+
+def run_chunk(func, chunk, args, collect):
+	"""Return func(chunk, *args) and, if collect is true, the Stats of the call as a dict"""
+	if not collect:
+		return func(chunk, *args), None
+
+	stats = enable_stats()
+	# workers are reused, count each chunk once
+	stats.reset()
+	try:
+		return func(chunk, *args), stats.as_dict()
+	finally:
+		disable_stats()
+
+
+def map_chunks(func, items, args=(), jobs=None, chunk_size=256):
+	"""Yield the results of func(chunk, *args) for chunks of items, in a process pool
+
+	func must return a list of results for the chunk, results are yielded in
+	input order. Items are sent to workers by chunks of chunk_size, to limit
+	the communication overhead. jobs defaults to the number of CPUs. At most
+	2 chunks per worker are in flight, so memory use stays bounded.
+	If stats are enabled, those of the workers are added to them.
+	"""
+	from concurrent.futures import ProcessPoolExecutor
+
+	if chunk_size < 1:
+		raise ValueError('chunk_size must be at least 1')
+	elif jobs is not None and jobs < 0:
+		raise ValueError('jobs must not be negative')
+	jobs = jobs or os.cpu_count() or 1
+	items = iter(items)
+	chunks = iter(lambda: list(itertools.islice(items, chunk_size)), [])
+	stats = STATS
+
+	def results(future):
+		res, chunk_stats = future.result()
+		if chunk_stats is not None:
+			stats.merge(chunk_stats)
+		return res
+
+	with ProcessPoolExecutor(jobs, initializer=warm_up) as executor:
+		pending = deque()
+		for chunk in chunks:
+			pending.append(executor.submit(run_chunk, func, chunk, args, stats is not None))
+			if len(pending) >= 2 * jobs:
+				yield from results(pending.popleft())
+
+		while pending:
+			yield from results(pending.popleft())
+
+
+def evaluate_lines_parallel(lines, jobs=None, chunk_size=256, **kwargs):
+	"""Evaluate expressions, one per line, in a pool of jobs processes
+
+	Like evaluate_lines, but errors are strings. See map_chunks() for jobs
+	and chunk_size.
+	"""
+	return map_chunks(evaluate_chunk, lines, (kwargs,), jobs, chunk_size)
+
+
+def line_ranges(buf, chunk_size=256):
+	"""Yield (start, end) offsets of the blocks of chunk_size lines of buf"""
+	if chunk_size < 1:
+		raise ValueError('chunk_size must be at least 1')
+
+	start = 0
+	size = len(buf)
+	while start < size:
+		end = start
+		for _ in range(chunk_size):
+			end = buf.find(b'\n', end) + 1
+			if not end:
+				end = size
+				break
+		yield start, end
+		start = end
+
+
+def evaluate_mapped_chunk(ranges, path, kwargs):
+	"""Like evaluate_chunk, for the lines of path in the (start, end) ranges"""
+	import locale
+	import mmap
+
+	encoding = locale.getpreferredencoding(False)
+	results = []
+	with open(path, 'rb') as fd, mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+		for start, end in ranges:
+			text = str(mm[start:end], encoding)
+			lines = text.split('\n')
+			if text.endswith('\n'):
+				lines.pop()
+			results.extend(evaluate_chunk(lines, kwargs))
+	return results
+
+
+def evaluate_file_parallel(path, jobs=None, chunk_size=256, **kwargs):
+	"""Like evaluate_lines_parallel, for the lines of file path
+
+	The file is memory-mapped, and workers get the offsets of their chunk of
+	lines instead of the lines, which they read from their own mapping. So
+	the lines are decoded by the workers, and do not go through pipes.
+	"""
+	import mmap
+
+	with open(path, 'rb') as fd:
+		if not os.path.getsize(path):
+			return
+		with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+			ranges = line_ranges(mm, chunk_size)
+			yield from map_chunks(evaluate_mapped_chunk, ranges, (path, kwargs), jobs, 1)
+
+
+def evaluate_values(texts):
+	"""Evaluate expressions, return a list of (value, exception) pairs"""
+	results = []
+	for text in texts:
+		try:
+			results.append((compute_from_string(text), None))
+		except EVAL_ERRORS as e:
+			results.append((None, e))
+	return results
+
+
+async def evaluate_iter(exprs, chunk_size=256, executor=None, max_pending=4, return_exceptions=False):
+	"""Evaluate expressions in an executor, yielding values in order
+
+	exprs can be an iterable or an async iterable. Expressions are evaluated
+	by chunks of chunk_size in executor (the default executor of the loop if
+	None, a ProcessPoolExecutor evaluates in parallel), so the event loop is
+	not blocked. At most max_pending chunks are
+	evaluated ahead of the consumer, more expressions are not read until it
+	catches up.
+	If return_exceptions is true, failed expressions yield their exception,
+	else the exception is raised.
+	"""
+	import asyncio
+
+	async def texts():
+		if hasattr(exprs, '__aiter__'):
+			async for text in exprs:
+				yield text
+		else:
+			for text in exprs:
+				yield text
+
+	def values(results):
+		for value, error in results:
+			if error is None:
+				yield value
+			elif return_exceptions:
+				yield error
+			else:
+				raise error
+
+	loop = asyncio.get_running_loop()
+	pending = deque()
+	chunk = []
+	try:
+		async for text in texts():
+			chunk.append(text)
+			if len(chunk) < chunk_size:
+				continue
+
+			pending.append(loop.run_in_executor(executor, evaluate_values, chunk))
+			chunk = []
+			if len(pending) >= max_pending:
+				for value in values(await pending.popleft()):
+					yield value
+
+		if chunk:
+			pending.append(loop.run_in_executor(executor, evaluate_values, chunk))
+		while pending:
+			for value in values(await pending.popleft()):
+				yield value
+	finally:
+		for future in pending:
+			future.cancel()
+
+
+async def evaluate_many(exprs, **kwargs):
+	"""Evaluate expressions without blocking the event loop, return the list of values
+
+	Arguments are the same as evaluate_iter().
+	"""
+	return [value async for value in evaluate_iter(exprs, **kwargs)]
+
+
+def write_results(results, outfile, name='-', block_size=1024, output_format='text'):
+	"""Write (result, error) pairs as lines of outfile, by blocks of lines
+
+	Errors are reported on stderr with their line number, and give an empty
+	line in outfile so output lines still match input lines. With the
+	"jsonl" output_format, they give an {"error": message} object instead,
+	and blank lines give null. The "npy" output_format is written by
+	write_npy(), outfile being binary.
+	Return the number of errors.
+	"""
+	if output_format == 'npy':
+		return write_npy(results, outfile, name, block_size)
+	elif output_format == 'jsonl':
+		import json
+
+	errors = 0
+	lineno = 0
+	while True:
+		block = []
+		for result, error in itertools.islice(results, block_size):
+			lineno += 1
+			if error is not None:
+				errors += 1
+				print('%s:%d: %s' % (name, lineno, error), file=sys.stderr)
+				if output_format == 'jsonl':
+					result = json.dumps({'error': str(error)})
+			elif not result and output_format == 'jsonl':
+				result = 'null'
+			block.append(result)
+
+		if not block:
+			return errors
+		block.append('')
+		outfile.write('\n'.join(block))
+
+
+NPY_DTYPES = {'datetime': '<M8[us]', 'duration': '<m8[us]', 'number': '<f8'}
+NPY_HEADER_SIZE = 128
+NAT = -2 ** 63
+
+
+def npy_header(dtype, count):
+	"""Return the header of a .npy file of count values of dtype, NPY_HEADER_SIZE long"""
+	import struct
+
+	header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (dtype, count)
+	header = header.ljust(NPY_HEADER_SIZE - 11) + '\n'
+	return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin-1')
+
+
+def pack_npy(kind, values):
+	"""Pack values as little-endian int64 or, for numbers, float64, None being NaT or NaN"""
+	import struct
+
+	if kind == 'number':
+		return struct.pack('<%dd' % len(values), *[math.nan if v is None else v for v in values])
+	return struct.pack('<%dq' % len(values), *[NAT if v is None else v for v in values])
+
+
+def write_npy(results, outfile, name='-', block_size=1024):
+	"""Write (result, error) pairs as a NumPy .npy array, outfile being a seekable binary file
+
+	Results are the (type, value) pairs of format_result with the "npy"
+	output_format. The array is datetime64[us], timedelta64[us] or float64,
+	after the type of the first result. Errors, blank lines and results of
+	another type give NaT or NaN, and are reported on stderr.
+	The values are written by blocks, and the header last, once the type
+	and number of values are known. Return the number of errors.
+	"""
+	start = outfile.tell()
+	outfile.write(bytes(NPY_HEADER_SIZE))
+
+	kind = None
+	missing = 0
+	count = 0
+	errors = 0
+	while True:
+		values = []
+		for result, error in itertools.islice(results, block_size):
+			value = None
+			if error is None and result:
+				rtype, value = result
+				if kind is None:
+					kind = rtype
+				elif rtype != kind:
+					error = 'Expected a %s, not a %s' % (kind, rtype)
+					value = None
+			if error is not None:
+				errors += 1
+				print('%s:%d: %s' % (name, count + missing + len(values) + 1, error), file=sys.stderr)
+			values.append(value)
+
+		if not values:
+			break
+		if kind is None:
+			# the type, and so NaT or NaN, is not known yet
+			missing += len(values)
+			continue
+		if missing:
+			values = [None] * missing + values
+			missing = 0
+		outfile.write(pack_npy(kind, values))
+		count += len(values)
+
+	kind = kind or 'number'
+	if missing:
+		outfile.write(pack_npy(kind, [None] * missing))
+		count += missing
+
+	end = outfile.tell()
+	outfile.seek(start)
+	outfile.write(npy_header(NPY_DTYPES[kind], count))
+	outfile.seek(end)
+	return errors
+
+
+def batch(path, jobs=1, chunk_size=256, **kwargs):
+	"""Evaluate expressions of a file (or stdin if path is "-"), one per line
+
+	Lines are read and results written as a stream, so memory use does not
+	depend on the input size. If jobs is not 1, lines are evaluated in
+	parallel, jobs being 0 to use all CPUs: by evaluate_file_parallel for
+	regular files, by evaluate_lines_parallel for stdin and pipes.
+	Return the number of lines that failed.
+	"""
+	def evaluate(infile):
+		if jobs == 1:
+			return evaluate_lines(infile, **kwargs)
+		return evaluate_lines_parallel(infile, jobs=jobs or None, chunk_size=chunk_size, **kwargs)
+
+	def write(results, name='-'):
+		output_format = kwargs.get('output_format') or 'text'
+		outfile = sys.stdout.buffer if output_format == 'npy' else sys.stdout
+		return write_results(results, outfile, name=name, output_format=output_format)
+
+	if path == '-':
+		return write(evaluate(sys.stdin))
+
+	if jobs != 1 and os.path.isfile(path):
+		return write(evaluate_file_parallel(path, jobs=jobs or None, chunk_size=chunk_size, **kwargs), path)
+
+	with open(path) as infile:
+		return write(evaluate(infile), path)
+
+
+def csv_columns(expr, header=None):
+	"""Return (variable, column index) pairs for the variables of expr
+
+	Variables are column numbers, starting at 1, or column names of header.
+	"""
+	columns = []
+	for name in sorted(expr.variables):
+		if name.isdigit() and int(name) > 0:
+			columns.append((name, int(name) - 1))
+		elif header is not None and name in header:
+			columns.append((name, header.index(name)))
+		else:
+			raise ValueError('unknown column: $%s' % name)
+	return tuple(columns)
+
+
+def evaluate_rows(rows, expr, columns, kwargs):
+	"""Return rows with the value of CompiledExpression expr appended, and errors
+
+	Return a list of (row, error) pairs, like evaluate_chunk: errors are
+	strings so they can be sent from worker processes.
+	"""
+	results = []
+	for row in rows:
+		try:
+			bindings = {name: row[index] for name, index in columns}
+			row.append(format_result(expr.evaluate(**bindings), **kwargs))
+			results.append((row, None))
+		except IndexError:
+			row.append('')
+			results.append((row, 'Missing columns, %d found' % (len(row) - 1)))
+		except EVAL_ERRORS as e:
+			row.append('')
+			results.append((row, str(e)))
+	return results
+
+
+def evaluate_csv(infile, outfile, text, delimiter=',', header=False, name='-', jobs=1, chunk_size=256, **kwargs):
+	"""Add a column with the value of expression text to each row of a CSV file
+
+	The expression is parsed once, its variables being column numbers ($1
+	is the first column) or, if header is true, names of the first row. The
+	first row then gets the expression as name of the new column.
+	Rows are read and written as a stream, and evaluated by chunks in jobs
+	processes if jobs is not 1 (0 for all CPUs). Errors are reported on
+	stderr with their row number and give an empty cell. Return the number
+	of errors.
+	"""
+	import csv
+
+	if chunk_size < 1:
+		raise ValueError('chunk_size must be at least 1')
+
+	reader = csv.reader(infile, delimiter=delimiter)
+	writer = csv.writer(outfile, delimiter=delimiter, lineterminator='\n')
+
+	first = None
+	if header:
+		first = next(reader, None)
+		if first is None:
+			return 0
+		writer.writerow(first + [text])
+	expr = compile(text)
+	args = (expr, csv_columns(expr, first), kwargs)
+
+	if jobs == 1:
+		chunks = iter(lambda: list(itertools.islice(reader, chunk_size)), [])
+		results = itertools.chain.from_iterable(evaluate_rows(chunk, *args) for chunk in chunks)
+	else:
+		results = map_chunks(evaluate_rows, reader, args, jobs or None, chunk_size)
+
+	errors = 0
+	rowno = 1 if header else 0
+	while True:
+		block = []
+		for row, error in itertools.islice(results, chunk_size):
+			rowno += 1
+			if error is not None:
+				errors += 1
+				print('%s:%d: %s' % (name, rowno, error), file=sys.stderr)
+			block.append(row)
+
+		if not block:
+			return errors
+		writer.writerows(block)
+
+
+def tabulate(path, text, **kwargs):
+	"""Evaluate expression text for each row of a CSV file (or stdin if path is "-")
+
+	Rows are written to stdout with the result as last column, see
+	evaluate_csv() for the arguments. Return the number of rows that failed.
+	"""
+	if path == '-':
+		return evaluate_csv(sys.stdin, sys.stdout, text, **kwargs)
+
+	with open(path, newline='') as infile:
+		return evaluate_csv(infile, sys.stdout, text, name=path, **kwargs)
+
+
+def parse_address(address):
+	"""Return ('unix', path) or ('tcp', (host, port)) for a server address
+
+	Addresses containing a "/" are Unix socket paths, others are "host:port"
+	or "port", host defaulting to localhost.
+	"""
+	if '/' in address:
+		return 'unix', address
+	host, _, port = address.rpartition(':')
+	return 'tcp', (host.strip('[]') or '127.0.0.1', int(port))
+
+
+async def handle_connection(reader, writer, **kwargs):
+	"""Answer the expressions sent by a client, one per line
+
+	Each answer is a line with a JSON object, with a "result" or an "error"
+	key. Clients can send requests without waiting for answers, answers
+	are sent in request order.
+	"""
+	import json
+
+	try:
+		while True:
+			try:
+				line = await reader.readline()
+			except ValueError:
+				# line too long, the stream can't be resynchronized
+				writer.write(b'{"error": "Line too long"}\n')
+				break
+			if not line:
+				break
+
+			text = line.decode('utf-8', 'replace')
+			result, error = next(evaluate_lines([text], **kwargs))
+			if error is None:
+				answer = {'result': result}
+			else:
+				answer = {'error': str(error)}
+			writer.write(json.dumps(answer).encode('utf-8') + b'\n')
+			# only waits when the client doesn't read its answers
+			await writer.drain()
+	except ConnectionError:
+		pass
+	finally:
+		writer.close()
+
+
+def check_socket_path(path):
+	"""Raise OSError if path exists and is not a stale Unix socket
+
+	asyncio replaces existing sockets, even those of a running server.
+	"""
+	import errno
+	import socket
+	import stat
+
+	try:
+		mode = os.stat(path).st_mode
+	except FileNotFoundError:
+		return
+	if not stat.S_ISSOCK(mode):
+		raise FileExistsError(errno.EEXIST, 'File exists and is not a socket', path)
+
+	with socket.socket(socket.AF_UNIX) as sock:
+		try:
+			sock.connect(path)
+		except ConnectionRefusedError:
+			# nobody listens, left by a server which didn't exit cleanly
+			return
+	raise OSError(errno.EADDRINUSE, 'Address already in use', path)
+
+
+async def start_server(address, **kwargs):
+	"""Start serving expression evaluation on address, return the asyncio server
+
+	A Unix socket path must not exist, or be a stale socket.
+	"""
+	import asyncio
+
+	def handler(reader, writer):
+		return handle_connection(reader, writer, **kwargs)
+
+	kind, addr = parse_address(address)
+	if kind == 'unix':
+		check_socket_path(addr)
+		return await asyncio.start_unix_server(handler, path=addr, backlog=1024)
+	return await asyncio.start_server(handler, addr[0], addr[1], backlog=1024)
+
+
+def serve(address, **kwargs):
+	"""Serve expression evaluation on address until interrupted
+
+	A Unix socket is removed on exit, if it is still the one created here.
+	"""
+	import asyncio
+	import stat
+
+	kind, addr = parse_address(address)
+	bound = []
+
+	async def run():
+		import signal
+
+		server = await start_server(address, **kwargs)
+		if kind == 'unix':
+			st = os.stat(addr)
+			bound.append((st.st_dev, st.st_ino))
+		print('chronocalc: serving on %s' % address, file=sys.stderr)
+
+		stopped = asyncio.Event()
+		try:
+			asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopped.set)
+		except NotImplementedError:
+			pass
+		async with server:
+			await stopped.wait()
+
+	warm_up()
+	try:
+		asyncio.run(run())
+	except KeyboardInterrupt:
+		pass
+	finally:
+		if bound:
+			try:
+				st = os.stat(addr)
+			except OSError:
+				pass
+			else:
+				if stat.S_ISSOCK(st.st_mode) and (st.st_dev, st.st_ino) == bound[0]:
+					os.unlink(addr)
 
 
 def repl(**kwargs):
@@ -871,16 +2720,107 @@ def repl(**kwargs):
 
 
 def main():
+	if len(sys.argv) == 2 and not sys.argv[1].startswith('-'):
+		# a single expression is the most common case, don't pay for argparse
+		do_one(sys.argv[1])
+		return
+
+	import argparse
+
+	def int_at_least(minimum):
+		def parse(text):
+			try:
+				value = int(text)
+			except ValueError:
+				raise argparse.ArgumentTypeError('invalid int value: %r' % text)
+			if value < minimum:
+				raise argparse.ArgumentTypeError('must be at least %d' % minimum)
+			return value
+		return parse
+
 	aparser = argparse.ArgumentParser()
 	aparser.add_argument('--exact-durations', action='store_const', const=True)
+	aparser.add_argument(
+		'--batch', nargs='?', const='-', metavar='FILE',
+		help='evaluate expressions of FILE (default: stdin), one per line',
+	)
+	aparser.add_argument(
+		'--csv', nargs='?', const='-', metavar='FILE',
+		help='evaluate expr for each row of FILE (default: stdin), columns being $1, $2...',
+	)
+	aparser.add_argument(
+		'--delimiter', default=',', metavar='CHAR',
+		help='with --csv, the column delimiter (default: "%(default)s")',
+	)
+	aparser.add_argument(
+		'--header', action='store_true',
+		help='with --csv, the first row has column names, usable as $name',
+	)
+	aparser.add_argument(
+		'-j', '--jobs', type=int_at_least(0), default=1, metavar='N',
+		help='with --batch or --csv, evaluate with N processes (0: one per CPU)',
+	)
+	aparser.add_argument(
+		'--chunk-size', type=int_at_least(1), default=256, metavar='N',
+		help='with --jobs, send lines to processes by chunks of N lines',
+	)
+	aparser.add_argument(
+		'--format', dest='output_format', default='text', choices=('text', 'jsonl', 'epoch-us', 'npy'),
+		help='with --batch, output format of the results (default: %(default)s), npy needing stdout to be a file; '
+		'with --csv, text or epoch-us',
+	)
+	aparser.add_argument(
+		'--serve', metavar='ADDRESS',
+		help='serve evaluation requests on ADDRESS, a Unix socket path or [HOST:]PORT',
+	)
+	aparser.add_argument(
+		'--stats', action='store_true',
+		help='print counters and timings of the lexer, parser and evaluator on stderr when done',
+	)
 	aparser.add_argument('expr', default=None, nargs='?')
 	args = aparser.parse_args()
 
 	kwargs = vars(args)
-	if args.expr is None:
-		repl(**kwargs)
-	else:
-		do_one(args.expr, **kwargs)
+	if args.serve is not None and (args.expr is not None or args.batch is not None or args.csv is not None):
+		aparser.error('expr, --batch and --csv cannot be used with --serve')
+	elif args.batch is not None and (args.expr is not None or args.csv is not None):
+		aparser.error('expr and --csv cannot be used with --batch')
+	elif args.csv is not None and args.expr is None:
+		aparser.error('--csv requires expr')
+
+	if args.output_format != 'text':
+		if args.batch is None and args.csv is None:
+			aparser.error('--format requires --batch or --csv')
+		elif args.csv is not None and args.output_format not in ('text', 'epoch-us'):
+			aparser.error('--format %s cannot be used with --csv' % args.output_format)
+		elif args.output_format == 'npy' and not sys.stdout.buffer.seekable():
+			aparser.error('--format npy requires stdout to be a file')
+
+	if args.stats:
+		enable_stats()
+	try:
+		if args.serve is not None:
+			try:
+				serve(args.serve, **kwargs)
+			except OSError as e:
+				sys.exit('chronocalc: cannot serve on %s: %s' % (args.serve, e.strerror or e))
+		elif args.batch is not None:
+			if batch(args.batch, **kwargs):
+				sys.exit(1)
+		elif args.csv is not None:
+			try:
+				failed = tabulate(args.csv, args.expr, **kwargs)
+			except (ParserException, ValueError) as e:
+				aparser.error(str(e))
+			if failed:
+				sys.exit(1)
+		elif args.expr is None:
+			repl(**kwargs)
+		else:
+			do_one(args.expr, **kwargs)
+	finally:
+		if args.stats:
+			print(disable_stats(), file=sys.stderr)
 
 # }}}
 
@@ -2,12 +2,25 @@
 # coding: utf-8
 # license: WTFPLv2 [http://wtfpl.net]
 
+import asyncio
+import contextlib
 import datetime
 from datetime import datetime as DT
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
 import unittest
 
 from dateutil.relativedelta import relativedelta as RD
 
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
 from chronocalc import *
 
 
@@ -18,6 +31,365 @@ class TestParseMethods(unittest.TestCase):
 	def assertFail(self, text, exc=ParserException):
 		self.assertRaises(exc, compute_from_string, text)
 
+	def test_lexer(self):
+		self.assertEqual([type(t) for t in do_lexer('2015-07-31 -3 days')], [ISO8601, Number, Unit])
+		self.assertEqual([type(t) for t in do_lexer('2015/07/31 3pm-1 - 1')], [Date, Time, Number, Minus, Number])
+		self.assertEqual([type(t) for t in do_lexer('(1d)')], [OpenParen, Number, Unit, CloseParen])
+		self.assertRaises(BadToken, do_lexer, '1 day + fail')
+
+	def test_tokens(self):
+		text = '2015-07-31 12:00 + 3 days'
+		tokens = do_lexer(text)
+		self.assertEqual([(t.start, t.end) for t in tokens], [(0, 16), (17, 18), (19, 20), (21, 25)])
+		self.assertIs(tokens[0].text, text)
+		self.assertFalse(hasattr(tokens[0], '__dict__'))
+		self.assertEqual(tokens[0].d['minute'], '00')
+		self.assertEqual((tokens[2].value(), tokens[3].value()), (3, 'days'))
+
+		time = do_lexer('1:20 pm')[0]
+		self.assertEqual(Time.group_index()['ampm'], [Time.re.groupindex['ampm'], Time.re.groupindex['ampm_2']])
+		self.assertEqual(time.groups('hour', 'second', 'ampm'), ('1', None, 'pm'))
+		self.assertEqual(do_lexer('3pm')[0].d, {'hour': '3', 'ampm': 'pm'})
+
+		ast = compile('1 day - 3 * $x').ast
+		self.assertIsInstance(ast, BinOp)
+		self.assertIsInstance(ast.op, Minus)
+		self.assertIsInstance(ast.right.left, Number)
+
+	def test_grammar(self):
+		compile_grammar(Expression)
+		self.assertEqual([cb.__name__ for _, cb in RULE_TABLES[Datetime]], ['r0', 'r0b', 'r1', 'r1b', 'r2'])
+		self.assertEqual(RULE_TABLES[Factor][2][0], (OpenParen, Expression, CloseParen))
+		self.assertIn(NumDuration, RULE_TABLES)
+
+	def test_memoize(self):
+		for text in ['2 * ((100 days + 2015/07/08) - (2015/07/01 - 48 hours))', '2015/07/08 11pm - 15 hours']:
+			self.assertEqual(str(compute_from_string(text, memoize=True)), str(compute_from_string(text)))
+		self.assertEqual(compute_from_string('(' * 30 + '1 day' + ')' * 30, memoize=True).delta, RD(days=1))
+		self.assertRaises(NotEnoughTokens, compute_from_string, '(1 day', memoize=True)
+		self.assertRaises(ExtraTokensError, compute_from_string, '1 day)', memoize=True)
+
+	def test_long_chains(self):
+		n = 2 * sys.getrecursionlimit()
+		self.assertEqual(str(compute_from_string(' + '.join(['1s'] * n))), str(compute_from_string('%d s' % n)))
+		self.assertEqual(compute_from_string(' - '.join(['1 day'] * 3 + ['2 hours * 2 / 4 * 3'] * n)).delta, RD(days=-1 - 3 * n // 24, hours=-(3 * n % 24)))
+		self.assertEqual(compile(' * '.join(['$x'] * n)).evaluate(x=1).value(), 1)
+
+	def test_syntax_errors(self):
+		self.assertFail('', BadSymbol)
+		self.assertFail(')', BadSymbol)
+		self.assertFail('1 day +* 2', ParserSyntaxError)
+		self.assertFail('(1 day', NotEnoughTokens)
+		self.assertFail('1 day 2', ExtraTokensError)
+
+		with self.assertRaises(ParserSyntaxError) as cm:
+			compute_from_string('1 day +* 2')
+		self.assertEqual(str(cm.exception), 'Unexpected symbol\n1 day +* 2\n       ^')
+
+	def test_compile(self):
+		expr = compile('$start + 3 weeks - 2 hours')
+		self.assertEqual(expr.variables, {'start'})
+		self.assertEqual(expr.evaluate(start=DT(2015, 7, 8)).datetime, DT(2015, 7, 28, 22))
+		self.assertEqual(expr.evaluate(start=datetime.date(2015, 7, 1)).datetime, DT(2015, 7, 21, 22))
+		self.assertEqual(expr.evaluate(start='2015/07/01 12:00').datetime, DT(2015, 7, 22, 10))
+		self.assertRaises(UnboundVariable, expr.evaluate)
+		self.assertRaises(AttributeError, setattr, expr, 'ast', None)
+
+		self.assertEqual(compile('$a / $b').evaluate(a=datetime.timedelta(hours=1), b=RD(minutes=30)).value(), 2)
+		self.assertEqual(compile('$n * 1 day').evaluate(n=2).delta, RD(days=2))
+		self.assertIsInstance(compile('now').ast, Deferred)
+		self.assertIsInstance(compile('12:00').ast, Deferred)
+		self.assertIsInstance(compile('2015/07/01 12:00').ast, Datetime)
+
+	def test_stats(self):
+		self.assertIsNone(disable_stats())
+		stats = enable_stats()
+		try:
+			cache = ExpressionCache()
+			cache.compute('2015/07/31 + 1 day')
+			cache.compute('2015/07/31 + 1 day')
+			compile('(1 day + 1 hour) * 2').evaluate()
+		finally:
+			self.assertIs(disable_stats(), stats)
+
+		self.assertEqual((stats.cache_hits, stats.cache_misses), (1, 1))
+		self.assertEqual(stats.tokens, 4 + 9)
+		self.assertGreater(stats.backtracks, 0)
+		self.assertGreater(stats.rule_attempts, stats.backtracks)
+		self.assertEqual(stats.runs, {'lex': 2, 'parse': 2, 'optimize': 2, 'compute': 2})
+		self.assertEqual(stats.as_dict()['tokens'], 13)
+
+		compute_from_string('1 week')
+		self.assertEqual(stats.cache_misses, 1)
+
+		# workers' stats are added to those of the main process
+		lines = ['%d days + 2015/07/08' % n for n in range(20)]
+		stats = enable_stats()
+		try:
+			list(evaluate_lines_parallel(lines, jobs=2, chunk_size=3))
+		finally:
+			disable_stats()
+		self.assertEqual(stats.tokens, 20 * 4)
+		self.assertEqual(stats.runs['compute'], 20)
+		self.assertEqual(stats.cache_hits + stats.cache_misses, 20)
+
+	def test_optimize(self):
+		expr = compile('((2 * 1 day + 3 hours)) + $ts')
+		self.assertIsInstance(expr.ast, BinOp)
+		self.assertEqual(expr.ast.left.delta, RD(days=2, hours=3))
+		self.assertEqual(expr.ast.right.value(), 'ts')
+		self.assertEqual(expr.evaluate(ts=DT(2015, 7, 8)).datetime, DT(2015, 7, 10, 3))
+
+		# not reordered, 2015/01/31 + 1 month - 1 month is 2015/01/28
+		expr = compile('$ts + 1 month - 1 month')
+		self.assertIsInstance(expr.ast.left, BinOp)
+		self.assertEqual(expr.evaluate(ts=DT(2015, 1, 31)).datetime, DT(2015, 1, 28))
+
+		self.assertIsInstance(compile('today + (1 day + 1 hour)').ast.right, BaseDuration)
+		self.assertIsInstance(compile('1 day / 2').ast, BaseDuration)
+		self.assertTrue(compile('1 day / 2 * 3').constant)
+
+		# errors are still raised when evaluating
+		self.assertIsInstance(compile('1 day / 0').ast, BinOp)
+		self.assertFail('1 day / 0', ZeroDivisionError)
+		self.assertFail('1 day * 2015/01/01 + $x', BadOperand)
+
+	def test_cache(self):
+		cache = ExpressionCache(maxsize=2)
+		res = cache.compute('1 day + 1 hour')
+		self.assertIs(cache.compute('1 day + 1 hour'), res)
+		self.assertEqual(cache.info(), CacheInfo(1, 1, 2, 1))
+
+		self.assertIsNot(cache.compute('now'), cache.compute('now'))
+		self.assertEqual(cache.info(), CacheInfo(2, 2, 2, 2))
+		cache.compute('1 hour')
+		self.assertEqual(list(cache.entries), ['now', '1 hour'])
+
+		cache.resize(0)
+		self.assertEqual(cache.info().currsize, 0)
+		self.assertEqual(cache.compute('1 day').delta, RD(days=1))
+
+	@unittest.skipUnless(numpy, 'numpy is not installed')
+	def test_evaluate_array(self):
+		starts = numpy.array(['2015-01-31', '2016-02-29T12:00'], dtype='M8[us]')
+		res = evaluate_array(compile('$start + 1 month - 2 hours'), start=starts)
+		self.assertEqual(res.tolist(), [DT(2015, 2, 27, 22), DT(2016, 3, 29, 10)])
+
+		res = evaluate_array(compile('$start - 2015/01/01'), start=starts)
+		self.assertEqual([d.delta for d in res], [RD(days=30), RD(years=1, months=1, days=28, hours=12)])
+
+		res = evaluate_array(compile('$d / 2 + 1 minute'), d=numpy.array([3600, 1], dtype='m8[s]'))
+		self.assertEqual(res.tolist(), [datetime.timedelta(minutes=31), datetime.timedelta(seconds=60.5)])
+
+		res = evaluate_array(compile('$n / $m'), n=numpy.arange(3), m=2)
+		self.assertEqual(res.tolist(), [0, 0.5, 1])
+		self.assertRaises(ZeroDivisionError, evaluate_array, compile('$n / $m'), n=numpy.arange(3), m=numpy.arange(3))
+		self.assertRaises(BadOperand, evaluate_array, compile('$start * 2'), start=starts)
+
+		# years and months are kept apart, like relativedelta does
+		n = numpy.array([1, 2])
+		expr = compile('($n * 1 year - 1 month) / 1 day')
+		self.assertEqual(evaluate_array(expr, n=n).tolist(), [expr.evaluate(n=1).value(), expr.evaluate(n=2).value()])
+		self.assertEqual(evaluate_array(expr, n=n).tolist(), [335, 700])
+		res = evaluate_array(compile('($n * 1 year - 1 month) * 2'), n=n)
+		self.assertEqual([str(d) for d in res], ['2 years, -2 months', '4 years, -2 months'])
+		res = evaluate_array(compile('$n * 1 year + 13 months'), n=n)
+		self.assertEqual([d.delta for d in res], [RD(years=2, months=1), RD(years=3, months=1)])
+
+		# out of datetime's range, the scalar path raises its error
+		self.assertRaises(ValueError, evaluate_array, compile('$start + 9000 years'), start=starts)
+		self.assertRaises(ValueError, evaluate_array, compile('$start - 2016 years + 1 month'), start=starts)
+
+	def test_duration_types(self):
+		fixed = compute_from_string('1 week, 25 hours')
+		self.assertIsInstance(fixed, TimedeltaDuration)
+		self.assertEqual(str(fixed), '8 days, 1 hour')
+		self.assertEqual(fixed.delta, RD(days=8, hours=1))
+		self.assertIsInstance(compute_from_string('1 week + 1 month'), RelativedeltaDuration)
+		self.assertIsInstance(compute_from_string('(1 month + 2 days) - 1 month'), TimedeltaDuration)
+		self.assertEqual(str(compute_from_string('1.5 hours * -3')), '-4 hours, -30 minutes')
+		self.assertEqual(compute_from_string('2015/03/15 01:10 - 2015/03/13 23:20').delta, RD(days=1, hours=1, minutes=50))
+
+	def test_duration_format(self):
+		for text in ('1 day, 1 ms', '-1 hour, 1 us', '2 months, 3 days', '1.5 hours', '0 s', '1.5 hours * -3', '2015/07/31 - 2015/06/01 12:00'):
+			v = compute_from_string(text)
+			self.assertEqual(format_result(v), str(v.approx()))
+			self.assertEqual(str(v), str(make_duration(v.delta)))
+		self.assertEqual(format_result(compute_from_string('-1 hour, 1 us')), '-1 days, 23 hours, 1 microsecond')
+		self.assertEqual(format_result(compute_from_string('2 months, 1 day, 2000 us')), '61 days, 2 milliseconds')
+		self.assertEqual(format_microseconds(0), '0 seconds')
+
+	def test_serve(self):
+		async def session(address):
+			server = await start_server(address)
+			async with server:
+				if address.startswith('/'):
+					reader, writer = await asyncio.open_unix_connection(address)
+				else:
+					port = server.sockets[0].getsockname()[1]
+					reader, writer = await asyncio.open_connection('127.0.0.1', port)
+				# pipelined requests
+				writer.write(b'1 day / 2\n\nfoo\n2015/07/31 + 1 month\n')
+				answers = [json.loads(await reader.readline()) for _ in range(4)]
+				writer.close()
+			return answers
+
+		self.assertEqual(parse_address('/run/cc.sock'), ('unix', '/run/cc.sock'))
+		self.assertEqual(parse_address('8000'), ('tcp', ('127.0.0.1', 8000)))
+		self.assertEqual(parse_address('0.0.0.0:8000'), ('tcp', ('0.0.0.0', 8000)))
+
+		with tempfile.TemporaryDirectory() as tmp:
+			for address in (os.path.join(tmp, 'cc.sock'), '127.0.0.1:0'):
+				answers = asyncio.run(session(address))
+				self.assertEqual(answers[0], {'result': '12 hours'})
+				self.assertEqual(answers[1], {'result': ''})
+				self.assertTrue(answers[2]['error'].startswith('Unrecognized token'))
+				self.assertEqual(answers[3], {'result': '2015-08-31 00:00:00'})
+
+		async def second_server(address):
+			server = await start_server(address)
+			async with server:
+				with self.assertRaises(OSError):
+					await start_server(address)
+
+		with tempfile.TemporaryDirectory() as tmp:
+			# existing files are neither replaced nor removed
+			path = os.path.join(tmp, 'data')
+			with open(path, 'w') as fd:
+				fd.write('important\n')
+			self.assertRaises(FileExistsError, serve, path)
+			with open(path) as fd:
+				self.assertEqual(fd.read(), 'important\n')
+
+			# nor are sockets of running servers
+			asyncio.run(second_server(os.path.join(tmp, 'cc.sock')))
+
+	def test_evaluate_many(self):
+		async def texts():
+			for n in range(5):
+				yield '%d days / 2' % n
+
+		values = asyncio.run(evaluate_many(['1 day / 2', '2015/07/31 + 1 month', '3 * 2'], chunk_size=2))
+		self.assertEqual([str(v) for v in values], ['12 hours', '2015-08-31 00:00:00', '6'])
+
+		values = asyncio.run(evaluate_many(texts(), chunk_size=2, max_pending=1))
+		self.assertEqual([str(v) for v in values], ['0 seconds', '12 hours', '1 day', '1 day, 12 hours', '2 days'])
+
+		values = asyncio.run(evaluate_many(['1 day', 'foo'], return_exceptions=True))
+		self.assertIsInstance(values[1], BadToken)
+		self.assertRaises(BadToken, asyncio.run, evaluate_many(['1 day', 'foo']))
+
+	def test_evaluate_csv(self):
+		data = 'start,end\n2015-07-31 12:00,2015-08-01\n2015/07/31 3pm,foo\n2015-07-31\n'
+		for jobs in (1, 2):
+			out = io.StringIO()
+			with contextlib.redirect_stderr(io.StringIO()) as err:
+				errors = evaluate_csv(io.StringIO(data), out, '$end - $1', header=True, jobs=jobs, chunk_size=2)
+			self.assertEqual(errors, 2)
+			self.assertEqual(out.getvalue().splitlines(), [
+				'start,end,$end - $1',
+				'2015-07-31 12:00,2015-08-01,12 hours',
+				'2015/07/31 3pm,foo,',
+				'2015-07-31,',
+			])
+			self.assertTrue(err.getvalue().startswith('-:3: Unrecognized token'))
+
+		out = io.StringIO()
+		evaluate_csv(io.StringIO('1 day\t2015-07-31\n'), out, '$2 + $1 * 2', delimiter='\t')
+		self.assertEqual(out.getvalue(), '1 day\t2015-07-31\t2015-08-02 00:00:00\n')
+		self.assertRaises(ValueError, evaluate_csv, io.StringIO(data), out, '$end + 1 day')
+		self.assertRaises(ValueError, evaluate_csv, io.StringIO(data), out, '$1 + 1 day', chunk_size=0)
+
+		# the expression is parsed once, then each cell
+		stats = enable_stats()
+		try:
+			evaluate_csv(io.StringIO('2015-07-31 12:34\n'), io.StringIO(), '$1 + 2 hours')
+		finally:
+			disable_stats()
+		self.assertEqual(stats.runs['lex'], 2)
+
+	def test_lazy_imports(self):
+		code = 'import sys, chronocalc; chronocalc.compute_from_string("1 day / 2"); print(sorted(sys.modules))'
+		out = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+		self.assertNotIn("'argparse'", out)
+		self.assertNotIn("'dateutil.relativedelta'", out)
+
+		self.assertEqual(str(compute_from_string('1 month + 1 day')), '1 month, 1 day')
+
+	def test_batch(self):
+		out = io.StringIO()
+		results = evaluate_lines(['1 day / 2\n', '\n', '1 day +* 2\n', '2015/07/08 + 3 weeks'])
+		with contextlib.redirect_stderr(io.StringIO()) as err:
+			self.assertEqual(write_results(results, out, block_size=2), 1)
+		self.assertEqual(out.getvalue(), '12 hours\n\n\n2015-07-29 00:00:00\n')
+		self.assertTrue(err.getvalue().startswith('-:3: Unexpected symbol\n'))
+
+		# errors while formatting or parsing don't stop the next lines
+		results = list(evaluate_lines(['1 day', '9999999999 days', '(' * 5000 + '1 day' + ')' * 5000, '2 days']))
+		self.assertEqual([res for res, err in results], ['1 day', '', '', '2 days'])
+		self.assertIsInstance(results[1][1], OverflowError)
+		self.assertIsInstance(results[2][1], RecursionError)
+		self.assertEqual([res for res, err in evaluate_lines_parallel(['1 day', '9999999999 days', '2 days'], jobs=2)], ['1 day', '', '2 days'])
+
+	def test_output_formats(self):
+		lines = ['1 day / 2', '', '1 day +* 2', '2015/07/08 + 3 weeks', '2015/07/31 - 2015/06/01', '3 * 2']
+
+		def output(output_format):
+			out = io.StringIO()
+			with contextlib.redirect_stderr(io.StringIO()):
+				write_results(evaluate_lines(lines, output_format=output_format), out, output_format=output_format)
+			return out.getvalue().splitlines()
+
+		self.assertEqual(output('epoch-us'), ['43200000000', '', '', '1438128000000000', '5184000000000', '6'])
+		self.assertEqual([json.loads(line) for line in output('jsonl')], [
+			{'type': 'duration', 'months': 0, 'microseconds': 43200000000},
+			None,
+			{'error': 'Unexpected symbol\n1 day +* 2\n       ^'},
+			{'type': 'datetime', 'value': '2015-07-29T00:00:00'},
+			{'type': 'duration', 'months': 1, 'microseconds': 30 * 86400 * 10 ** 6},
+			{'type': 'number', 'value': 6},
+		])
+
+		out = io.BytesIO(b'x')
+		out.seek(1)
+		with contextlib.redirect_stderr(io.StringIO()) as err:
+			self.assertEqual(write_npy(evaluate_lines(lines, output_format='npy'), out, block_size=1), 3)
+		self.assertEqual(len(out.getvalue()), 1 + NPY_HEADER_SIZE + 6 * 8)
+		self.assertIn("'descr': '<m8[us]', 'fortran_order': False, 'shape': (6,)", out.getvalue().decode('latin-1'))
+		self.assertIn('-:4: Expected a duration, not a datetime', err.getvalue())
+		if numpy is not None:
+			out.seek(1)
+			array = numpy.load(out)
+			self.assertEqual(array.dtype, numpy.dtype('m8[us]'))
+			self.assertEqual(array[[0, 4]].tolist(), [datetime.timedelta(hours=12), datetime.timedelta(days=60)])
+			self.assertTrue(numpy.isnat(array[[1, 2, 3, 5]]).all())
+
+			out = io.BytesIO()
+			with contextlib.redirect_stderr(io.StringIO()):
+				write_npy(evaluate_lines(['', 'foo', '1 / 2'], output_format='npy'), out, block_size=1)
+			out.seek(0)
+			self.assertEqual(numpy.load(out)[2], 0.5)
+
+	def test_batch_parallel(self):
+		lines = ['%d days + 2015/07/08' % n for n in range(50)] + ['1 day +* 2']
+		expected = [(res, err and str(err)) for res, err in evaluate_lines(lines)]
+		self.assertEqual(list(evaluate_lines_parallel(lines, jobs=2, chunk_size=7)), expected)
+		self.assertRaises(ValueError, list, evaluate_lines_parallel(lines, jobs=2, chunk_size=0))
+		self.assertRaises(ValueError, list, evaluate_lines_parallel(lines, jobs=-1))
+		self.assertEqual(expected[-1], ('', 'Unexpected symbol\n1 day +* 2\n       ^'))
+
+		self.assertEqual(list(line_ranges(b'a\nb\n\nc', 2)), [(0, 4), (4, 6)])
+		self.assertEqual(list(line_ranges(b'a\nb\n', 2)), [(0, 4)])
+		self.assertRaises(ValueError, list, line_ranges(b'a\nb\n', 0))
+		with tempfile.TemporaryDirectory() as tmp:
+			path = os.path.join(tmp, 'exprs')
+			with open(path, 'w') as fd:
+				fd.write('\r\n'.join(lines))
+			self.assertEqual(list(evaluate_file_parallel(path, jobs=2, chunk_size=7)), expected)
+			self.assertRaises(ValueError, list, evaluate_file_parallel(path, jobs=2, chunk_size=0))
+			open(path, 'w').close()
+			self.assertEqual(list(evaluate_file_parallel(path, jobs=2)), [])
+
 	def test_datetimes(self):
 		self.assertEqual(compute_from_string('2015/07/09').datetime, DT(2015, 7, 9))
 		self.assertEqual(compute_from_string('2015/07/10 00:00').datetime, DT(2015, 7, 10))
@@ -46,6 +418,19 @@ class TestParseMethods(unittest.TestCase):
 		self.assertFail('2015-01-01 00:99', InvalidDate)
 		self.assertFail('fail')
 
+		# fixed-width forms are decoded without the regex groups, errors must not change
+		def error(text):
+			try:
+				compute_from_string(text)
+			except InvalidDate as e:
+				return str(e.exc)
+
+		self.assertEqual(error('2015-02-29 12:00'), error('2015-02-29  12:00'))
+		self.assertEqual(error('2015-01-01T24:00:00'), error('2015-01-01  24:00:00'))
+		self.assertEqual(error('20150100T1200'), error('2015-01-00  12:00'))
+		self.assertEqual(error('2015/13/01'), error('2015/13/1'))
+		self.assertEqual(error('12:60'), error('12:60:00.000'))
+
 	def test_durations(self):
 		self.assertEqual(compute_from_string('1 second').delta, RD(seconds=1))
 		self.assertEqual(compute_from_string('86410 seconds').delta, RD(days=1, seconds=10))